@@ -0,0 +1,392 @@
+"""
+公告推播
+
+宿網斷線等需要通知所有人的時候，對收集到的追蹤者以 multicast 發送訊息：
+    python announce.py count
+    python announce.py send "今晚 22:00 至 23:00 宿網維修" [--rate 20] [--restart] [--dry-run]
+
+每 500 人一批，經過 token bucket 限流，失敗時重試；
+每送完一批就寫入 checkpoint，中斷後用同樣的內容再跑一次會從下一批繼續。
+追蹤者的 user_id 由 app.py 從 follow 與訊息事件收集 (見 FollowerStore)。
+"""
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只能防止同一個 process 重複發送
+    fcntl = None
+
+import requests
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+import storage
+from dispatch import Reply
+from ratelimit import TokenBucket
+from replies import multicast_raw
+
+logger = logging.getLogger(__name__)
+
+MULTICAST_LIMIT = 500
+USER_ID_PATTERN = re.compile(r"U[0-9a-f]{32}")
+DEFAULT_FOLLOWERS_PATH = os.path.join(
+    tempfile.gettempdir(), "dromnet-followers.sqlite3"
+)
+DEFAULT_CHECKPOINT_PATH = os.path.join(tempfile.gettempdir(), "dromnet-announce.json")
+
+
+class FollowerStore:
+    """
+    追蹤者的 user_id
+
+    LINE 的 user_id 是 U 加上 32 個 16 進位字元，存成 16 bytes 的 BLOB。
+    同一個 process 最近寫過的 user_id 記在記憶體，重複的訊息不會再寫資料庫。
+
+    :params path: 資料庫檔案
+    :params recent: 記在記憶體的 user_id 數量
+    """
+
+    def __init__(self, path, recent=10000):
+        self.path = path
+        self.recent = recent
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._connect = storage.LocalConnection(path).get
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS followers (id BLOB PRIMARY KEY) WITHOUT ROWID"
+        )
+
+    @staticmethod
+    def _encode(user_id):
+        if not USER_ID_PATTERN.fullmatch(user_id or ""):
+            return None
+        return bytes.fromhex(user_id[1:])
+
+    def add(self, user_id):
+        key = self._encode(user_id)
+        if key is None:
+            return
+        with self._lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                return
+            self._recent[key] = None
+            if len(self._recent) > self.recent:
+                self._recent.popitem(last=False)
+        self._connect().execute("INSERT OR IGNORE INTO followers VALUES (?)", (key,))
+
+    def remove(self, user_id):
+        key = self._encode(user_id)
+        if key is None:
+            return
+        with self._lock:
+            self._recent.pop(key, None)
+        self._connect().execute("DELETE FROM followers WHERE id = ?", (key,))
+
+    def __iter__(self):
+        # 固定順序，中斷後重跑時批次的切法才會一樣
+        for (key,) in self._connect().execute("SELECT id FROM followers ORDER BY id"):
+            yield "U" + key.hex()
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM followers").fetchone()[0]
+
+
+def batches(user_ids, size=MULTICAST_LIMIT):
+    user_ids = list(user_ids)
+    return [user_ids[i : i + size] for i in range(0, len(user_ids), size)]
+
+
+def job_id(payload, user_ids):
+    """同樣的內容與收件人得到同樣的 ID，用來判斷 checkpoint 是不是同一次公告"""
+    digest = hashlib.sha1(payload)
+    for user_id in user_ids:
+        digest.update(user_id.encode("ascii"))
+    return digest.hexdigest()[:16]
+
+
+def send_with_retries(send, bucket, retries=3, backoff=1.0):
+    """
+    呼叫 send()，每次呼叫前從 bucket 取一個 token，429 / 5xx / 連線失敗時重試
+
+    send 需要帶 retry key，重試時 LINE 才不會重複發送。成功時回傳 True。
+
+    :params retries: 最多重試幾次
+    :params backoff: 第一次重試前等待的秒數，之後每次加倍，有 Retry-After 時以它為準
+    """
+    delay = backoff
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            send()
+            return True
+        except LineBotApiError as e:
+            if e.status_code == 409 and e.accepted_request_id:
+                # 同一個 retry key 之前已經送出過
+                return True
+            if e.status_code != 429 and e.status_code < 500:
+                logger.error("送出失敗，不重試：%s %s", e.status_code, e)
+                return False
+            retry_after = (e.headers or {}).get("Retry-After")
+            wait = float(retry_after) if retry_after else delay
+            logger.warning("送出失敗 (%s)，%.1f 秒後重試", e.status_code, wait)
+        except requests.RequestException as e:
+            wait = delay
+            logger.warning("連線失敗 (%s)，%.1f 秒後重試", e, wait)
+        if attempt < retries:
+            time.sleep(wait)
+            delay *= 2
+    return False
+
+
+class Announcer:
+    """
+    同一時間只會有一個公告在發送：process 內用 threading.Lock，
+    不同 gunicorn worker 之間用 checkpoint 旁邊的 .lock 檔 (flock)。
+
+    :params line_bot_api
+    :params bucket: TokenBucket，每次 multicast 取一個 token
+    :params checkpoint_path: 記錄已送出的批次
+    :params retries: 每一批最多重試幾次
+    :params backoff: 第一次重試前等待的秒數，之後每次加倍
+    """
+
+    def __init__(
+        self,
+        line_bot_api,
+        bucket,
+        checkpoint_path=DEFAULT_CHECKPOINT_PATH,
+        retries=3,
+        backoff=1.0,
+        timeout=None,
+    ):
+        self.line_bot_api = line_bot_api
+        self.bucket = bucket
+        self.checkpoint_path = checkpoint_path
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._running = threading.Lock()
+        self._lock_file = None
+        self._thread = None
+
+    def _lock_path(self):
+        return self.checkpoint_path + ".lock"
+
+    def _acquire(self):
+        """取得發送的權利，其他 thread 或 worker 正在發送時回傳 False。"""
+        if not self._running.acquire(blocking=False):
+            return False
+        if fcntl is None:
+            return True
+        lock_file = open(self._lock_path(), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            self._running.release()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _release(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+        self._running.release()
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_checkpoint(self, checkpoint):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.checkpoint_path)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(checkpoint, f)
+            os.replace(tmp_path, self.checkpoint_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def run(self, messages, user_ids, restart=False, notification_disabled=False):
+        """
+        發送公告，回傳 checkpoint (包含已送出與失敗的批次)
+
+        :params messages: 要送出的訊息 list
+        :params user_ids: 收件人，順序需固定
+        :params restart: 忽略上次的 checkpoint 從頭送
+        """
+        if not self._acquire():
+            raise RuntimeError("已經有公告正在發送")
+        try:
+            return self._run(messages, user_ids, restart, notification_disabled)
+        finally:
+            self._release()
+
+    def _run(self, messages, user_ids, restart, notification_disabled):
+        payload = Reply(messages).payload
+        user_ids = list(user_ids)
+        groups = batches(user_ids)
+        job = job_id(payload, user_ids)
+
+        checkpoint = self.load_checkpoint()
+        if restart or checkpoint is None or checkpoint.get("job") != job:
+            checkpoint = {
+                "job": job,
+                "recipients": len(user_ids),
+                "batches": len(groups),
+                "done": [],
+                "failed": [],
+                "retry_keys": {},
+                "started": time.time(),
+            }
+        else:
+            logger.info("從 checkpoint 繼續：已送出 %d 批", len(checkpoint["done"]))
+            checkpoint["failed"] = []
+        done = set(checkpoint["done"])
+
+        for i, group in enumerate(groups):
+            if i in done:
+                continue
+            # retry key 先寫進 checkpoint，中斷後重送同一批時 LINE 不會重複發送
+            retry_key = checkpoint["retry_keys"].setdefault(str(i), str(uuid.uuid4()))
+            self._save_checkpoint(checkpoint)
+            send = functools.partial(
+                multicast_raw,
+                self.line_bot_api,
+                group,
+                payload,
+                notification_disabled=notification_disabled,
+                retry_key=retry_key,
+                timeout=self.timeout,
+            )
+            if send_with_retries(send, self.bucket, self.retries, self.backoff):
+                checkpoint["done"].append(i)
+            else:
+                checkpoint["failed"].append(i)
+            self._save_checkpoint(checkpoint)
+
+        checkpoint["finished"] = time.time()
+        self._save_checkpoint(checkpoint)
+        logger.info(
+            "公告 %s 完成：%d 批成功、%d 批失敗",
+            job,
+            len(checkpoint["done"]),
+            len(checkpoint["failed"]),
+        )
+        return checkpoint
+
+    def start(self, messages, user_ids, restart=False, notification_disabled=False):
+        """在背景 thread 發送，已經有公告在發送時回傳 False。"""
+        # 先拿到鎖再啟動 thread，同時進來的兩個請求只有一個會成功
+        if not self._acquire():
+            return False
+
+        def run():
+            try:
+                self._run(messages, user_ids, restart, notification_disabled)
+            except Exception:
+                logger.exception("公告發送失敗")
+            finally:
+                self._release()
+
+        self._thread = threading.Thread(target=run, name="announce", daemon=True)
+        self._thread.start()
+        return True
+
+    @property
+    def running(self):
+        """這個 process 或其他 worker 是否正在發送"""
+        if self._running.locked():
+            return True
+        if fcntl is None:
+            return False
+        with open(self._lock_path(), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return False
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    arg_parser = argparse.ArgumentParser(description="對所有追蹤者發送公告")
+    arg_parser.add_argument(
+        "--followers",
+        default=os.environ.get("FOLLOWERS_PATH", DEFAULT_FOLLOWERS_PATH),
+        help="追蹤者資料庫",
+    )
+    sub = arg_parser.add_subparsers(dest="command")
+    sub.add_parser("count", help="顯示追蹤者人數")
+    send_parser = sub.add_parser("send", help="發送文字公告")
+    send_parser.add_argument("text")
+    send_parser.add_argument(
+        "--rate", type=float, default=float(os.environ.get("ANNOUNCE_RATE", 20))
+    )
+    send_parser.add_argument(
+        "--checkpoint",
+        default=os.environ.get("ANNOUNCE_CHECKPOINT", DEFAULT_CHECKPOINT_PATH),
+    )
+    send_parser.add_argument("--retries", type=int, default=3)
+    send_parser.add_argument("--restart", action="store_true", help="忽略上次的進度")
+    send_parser.add_argument("--silent", action="store_true", help="不發出通知聲")
+    send_parser.add_argument("--dry-run", action="store_true", help="只顯示會送幾批")
+    args = arg_parser.parse_args()
+
+    followers = FollowerStore(args.followers)
+    if args.command == "count":
+        print(len(followers))
+    elif args.command == "send":
+        user_ids = list(followers)
+        if args.dry_run:
+            print(f"{len(user_ids)} 人，{len(batches(user_ids))} 批")
+            return
+        line_bot_api = LineBotApi(
+            os.environ.get("CHANNEL_ACCESS_TOKEN"),
+            endpoint=os.environ.get(
+                "LINE_API_ENDPOINT", LineBotApi.DEFAULT_API_ENDPOINT
+            ),
+        )
+        announcer = Announcer(
+            line_bot_api,
+            TokenBucket(args.rate),
+            checkpoint_path=args.checkpoint,
+            retries=args.retries,
+        )
+        checkpoint = announcer.run(
+            [TextSendMessage(text=args.text)],
+            user_ids,
+            restart=args.restart,
+            notification_disabled=args.silent,
+        )
+        print(
+            f"{len(checkpoint['done'])}/{checkpoint['batches']} 批成功，"
+            f"失敗的批次：{checkpoint['failed']}"
+        )
+    else:
+        arg_parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,41 @@
-from flask import Flask, request, abort, render_template
+from flask import Flask, request, abort, render_template, send_file
 from urllib.parse import urlparse
 
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import (
-    MessageEvent,
-    TextMessage,
-    TextSendMessage,
-    TemplateSendMessage,
-    MessageAction,
-    QuickReply,
-    QuickReplyButton,
-)
-from linebot.models.actions import URIAction, MessageAction
-from linebot.models.template import CarouselColumn, CarouselTemplate
-
-import utils
-import io
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+import announce
+import assets
+import background
+import dedupe
+import fastparse
+import http_pool
+import intents
+import metrics
+import push
+import ratelimit
+import replies
+import resizer
+import session
+import functools
+import hmac
+import logging
 import os
+import tempfile
+import time
 
 app = Flask(__name__)
+# USE_X_SENDFILE=1 時由前端的 nginx/apache 送檔，否則 gunicorn 會用 sendfile(2)
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE") == "1"
+app.add_template_global(assets.asset_url)
+
+# /img/<寬度>/<路徑> 即時縮圖的磁碟快取
+resize_cache = resizer.ResizeCache(
+    os.environ.get("RESIZE_CACHE_DIR")
+    or os.path.join(tempfile.gettempdir(), "dromnet-img"),
+    max_bytes=int(os.environ.get("RESIZE_CACHE_MB", 100)) * 1024 * 1024,
+)
 
 # =========== 載入開發時環境 ===========
 # from config import config
@@ -29,11 +45,40 @@ app = Flask(__name__)
 # else:
 #     app.config.from_object(config["dev"])
 # line_bot_api = LineBotApi(app.config["CHANNEL_ACCESS_TOKEN"])
-# handler = WebhookHandler(app.config["CHANNEL_SECRET"])
+# parser = WebhookParser(app.config["CHANNEL_SECRET"])
 
 # =========== 載入上線時環境 ===========
-line_bot_api = LineBotApi(os.environ.get("CHANNEL_ACCESS_TOKEN"))
-handler = WebhookHandler(os.environ.get("CHANNEL_SECRET"))
+line_bot_api = LineBotApi(
+    os.environ.get("CHANNEL_ACCESS_TOKEN"),
+    # 測試時可以指向 bench/stub_line_api.py
+    endpoint=os.environ.get("LINE_API_ENDPOINT", LineBotApi.DEFAULT_API_ENDPOINT),
+    timeout=(
+        float(os.environ.get("LINE_CONNECT_TIMEOUT", 3.05)),
+        float(os.environ.get("LINE_READ_TIMEOUT", 10)),
+    ),
+    # 共用連線池，LINE_HTTP_CLIENT=requests 時改回 SDK 預設的 RequestsHttpClient
+    http_client=None
+    if os.environ.get("LINE_HTTP_CLIENT") == "requests"
+    else functools.partial(
+        http_pool.PooledHttpClient,
+        pool_size=int(os.environ.get("LINE_POOL_SIZE", 10)),
+        on_response=metrics.record_line_api,
+    ),
+)
+channel_secret = os.environ.get("CHANNEL_SECRET")
+
+# REPLY_MODE=raw 時直接送出預先序列化好的回覆，不經過 SDK 的 model 轉換
+RAW_REPLY = os.environ.get("REPLY_MODE") == "raw"
+# 有設定 BOT_HOST (例如 https://example.herokuapp.com) 就在啟動時先建好所有回覆
+# 內容重新載入時也會在換上之前先建好
+if os.environ.get("BOT_HOST"):
+
+    def warm(graph):
+        graph.warm(os.environ["BOT_HOST"], serialize=RAW_REPLY)
+
+    intents.store.on_load = warm
+    # 用 loaded 而不是 current，preload 時不在 master 裡啟動檢查檔案的 thread
+    warm(intents.store.loaded)
 
 
 @app.route("/", methods=["GET"])
@@ -44,1021 +89,443 @@ def index():
     )
 
 
+@app.route("/assets/<path:filename>", methods=["GET"])
+def asset(filename):
+    # 網址帶有內容 hash，內容變了網址就會跟著變，所以可以永久快取
+    path, digest = assets.resolve_fingerprint(filename)
+    if path is None:
+        abort(404)
+    response = send_file(
+        os.path.join(assets.IMG_DIR, path),
+        conditional=True,
+        add_etags=False,
+        cache_timeout=0,
+    )
+    if digest == assets.content_hash(path):
+        response.set_etag(digest)
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        # 舊訊息裡的網址，內容已經更新過，照樣給圖但不要快取
+        response.cache_control.public = False
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route("/img/<int:width>/<path:filename>", methods=["GET"])
+def resized_image(filename, width):
+    out = resize_cache.get(filename, width)
+    if out is None:
+        abort(404)
+    response = send_file(out, mimetype="image/jpeg", conditional=True)
+    if request.args.get("v") == assets.content_hash(filename):
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = 86400
+    response.cache_control.public = True
+    return response
+
+
 @app.route("/callback", methods=["POST"])
 def callback():
     # get X-Line-Signature header value
     signature = request.headers["X-Line-Signature"]
 
-    # get request body as text
-    body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    # get request body as bytes，簽章直接對原始 bytes 驗證
+    body = request.get_data()
+    if app.logger.isEnabledFor(logging.INFO):
+        app.logger.info("Request body: " + body.decode("utf-8", "replace"))
     # handle webhook body
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    with metrics.signature_seconds.time():
+        valid = fastparse.verify(body, signature, channel_secret)
+    if not valid:
+        metrics.signature_failures.inc()
         print(
             "Invalid signature. Please check your channel access token/channel secret."
         )
         abort(400)
+    events = fastparse.events(body)
+
+    if dedupe_store is not None:
+        # 重送的事件已經處理過，直接回 200 不再回覆
+        events = dedupe.unique_events(dedupe_store, events)
+
+    host = request_host()
+    if inbound_limiter is not None:
+        events, warnings = admit_events(events, host)
+        send_warnings(warnings)
+    if not events:
+        # 全部是重複或被限流的事件，不用佔一個佇列的位置
+        return "OK"
+    if reply_queue is None:
+        handle_events(events, host)
+    elif not reply_queue.submit((events, host)):
+        if dedupe_store is not None:
+            # 這次沒有處理，LINE 重送時不能當成重複的事件略過
+            dedupe.forget_events(dedupe_store, events)
+        abort(503)
 
     return "OK"
 
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    host = f"https://{urlparse(request.base_url).hostname}"
-    user = event.source.user_id
-    # Step 1
-    if event.message.text == "新生":
-        carousel_template_message = TemplateSendMessage(
-            alt_text="歡迎使用中華大學宿網會的簡易小機器人, 請至手機查看訊息。",
-            template=CarouselTemplate(
-                columns=[
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/new/s1.jpeg",
-                        title="第一步：購買一條網路線",
-                        text="規格：RJ-45 接口。\n長度：建議先到床位測量使用範圍。\n需要將網路線插入床位的壁孔才能使用。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/new/s1.jpeg",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/new/s2.jpeg",
-                        title="第二步：檢查電腦有無網路孔",
-                        text="無網路孔請往右滑向第三步。\n學校宿舍內無 WIFI，教室則有公共 WIFI。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/new/s2.jpeg",
-                            )
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/new/s3.jpeg",
-                        title="第三步：電腦無網路孔需購買轉接頭",
-                        text="轉接頭名稱：「RJ-45 轉 USB」",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/new/s3.jpeg",
-                            )
-                        ],
-                    ),
-                ]
-            ),
-        )
-        confirm_template_message = utils.ConfirmWindow(
-            context="上面步驟已完成，你是屬於？", success_string="男生宿舍", error_string="女生宿舍"
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[carousel_template_message, confirm_template_message],
-        )
-    # # Step 2 "一宿五樓", "二宿", "三宿"
-    elif event.message.text == "男生宿舍":
-        buttons_template_message = utils.ButtonWindow(
-            title="請選擇你的宿舍及樓層：",
-            context="例如房號：1401，第一位為宿舍號碼，第二位為樓層，後兩碼為房號。\n請選擇下面的選項：",
-            number=3,
-            label_list=["一宿五樓", "二宿", "三宿"],
-        )
-        line_bot_api.reply_message(event.reply_token, buttons_template_message)
-    # # Step 2 "一宿", "四宿"
-    elif event.message.text == "女生宿舍":
-        buttons_template_message = utils.ButtonWindow(
-            title="請選擇妳的宿舍：",
-            context="例如房號：1401，第一位為宿舍號碼，第二位為樓層，後兩碼為房號。\n請選擇下面的選項：",
-            number=2,
-            label_list=["一宿", "四宿"],
-        )
-        line_bot_api.reply_message(event.reply_token, buttons_template_message)
-    # # # Step 3 "一宿五樓"
-    elif event.message.text == "一宿五樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/1-5.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="透過上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
-    # # # Step 3 "一宿"
-    elif event.message.text == "一宿":
-        buttons_template_message = utils.ButtonWindow(
-            title="請選擇妳的樓層：",
-            context="請選擇下面的選項：",
-            number=3,
-            label_list=["一宿二樓", "一宿三樓", "一宿四樓"],
-        )
-        line_bot_api.reply_message(event.reply_token, buttons_template_message)
-    # # # Step 3 "二宿"
-    elif event.message.text == "二宿":
-        buttons_template_message_1 = utils.ButtonWindow(
-            title="請選擇你的樓層：",
-            context="請選擇下面的選項：",
-            number=4,
-            label_list=["二宿二樓", "二宿三樓", "二宿四樓", "二宿五樓"],
-        )
-        buttons_template_message_2 = utils.ButtonWindow(
-            title="請選擇你的樓層：",
-            context="請選擇下面的選項：",
-            number=3,
-            label_list=["二宿六樓", "二宿七樓", "二宿八樓"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[buttons_template_message_1, buttons_template_message_2],
-        )
-    # # # Step 3 "三宿"
-    elif event.message.text == "三宿":
-        buttons_template_message_1 = utils.ButtonWindow(
-            title="請選擇你的樓層：",
-            context="請選擇下面的選項：",
-            number=3,
-            label_list=["三宿一樓", "三宿二樓", "三宿三樓"],
-        )
-        buttons_template_message_2 = utils.ButtonWindow(
-            title="請選擇你的樓層：",
-            context="請選擇下面的選項：",
-            number=3,
-            label_list=["三宿四樓", "三宿五樓", "三宿六樓"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[buttons_template_message_1, buttons_template_message_2],
-        )
-    # # # Step 3 "四宿"
-    elif event.message.text == "四宿":
-        buttons_template_message_1 = utils.ButtonWindow(
-            title="請選擇妳的樓層：",
-            context="請選擇下面的選項：",
-            number=3,
-            label_list=["四宿一樓", "四宿二樓", "四宿三樓"],
-        )
-        buttons_template_message_2 = utils.ButtonWindow(
-            title="請選擇妳的樓層：",
-            context="請選擇下面的選項：",
-            number=3,
-            label_list=["四宿四樓", "四宿五樓", "四宿六樓"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[buttons_template_message_1, buttons_template_message_2],
-        )
-    elif event.message.text == "一宿二樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/1-2.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+def require_admin():
+    # 沒有設定 ADMIN_TOKEN 時管理功能一律關閉
+    token = os.environ.get("ADMIN_TOKEN")
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        abort(401)
 
-    elif event.message.text == "一宿三樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/1-3.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "一宿四樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/1-4.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+@app.route("/admin/announce", methods=["GET"])
+def announce_status():
+    require_admin()
+    return {
+        "running": announcer.running,
+        "followers": len(followers) if followers is not None else 0,
+        "checkpoint": announcer.load_checkpoint(),
+    }
 
-    elif event.message.text == "二宿二樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/2-2.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "二宿三樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/2-3.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+@app.route("/admin/announce", methods=["POST"])
+def announce_send():
+    """body 為 {"text": "公告內容", "restart": false, "silent": false}"""
+    require_admin()
+    data = request.get_json(force=True, silent=True) or {}
+    if not data.get("text") or followers is None:
+        abort(400)
+    user_ids = list(followers)
+    started = announcer.start(
+        [TextSendMessage(text=data["text"])],
+        user_ids,
+        restart=bool(data.get("restart")),
+        notification_disabled=bool(data.get("silent")),
+    )
+    if not started:
+        abort(409)
+    return {"recipients": len(user_ids)}, 202
 
-    elif event.message.text == "二宿四樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/2-4.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "二宿五樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/2-5.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+@app.route("/metrics", methods=["GET"])
+def metrics_text():
+    return metrics.registry.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
 
-    elif event.message.text == "二宿六樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/2-6.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "二宿七樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/2-7.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+def request_host():
+    return f"https://{urlparse(request.base_url).hostname}"
 
-    elif event.message.text == "二宿八樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/2-8.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "三宿一樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/3-1.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+def handle_events(events, host):
+    # 同一個使用者的事件依序處理，位置才會照訊息的順序更新
+    event_fanout.run(
+        functools.partial(handle_event, host=host),
+        events,
+        key=lambda event: event.user_id,
+    )
 
-    elif event.message.text == "三宿二樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/3-2.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "三宿三樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/3-3.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+def handle_event(event, host):
+    """
+    :params event: fastparse.Event，文字訊息以外的事件只用來記錄追蹤者
+    """
+    record_follower(event)
+    if event.text is not None:
+        handle_message(event, host)
 
-    elif event.message.text == "三宿四樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/3-4.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "三宿五樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/3-5.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+def record_follower(event):
+    """把追蹤 / 取消追蹤記到 followers (會寫入 SQLite)"""
+    user = event.user_id
+    if followers is not None and user is not None:
+        if event.type == "unfollow":
+            followers.remove(user)
+        else:
+            followers.add(user)
 
-    elif event.message.text == "三宿六樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/3-6.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "四宿一樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/4-1.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+def handle_message(event, host):
+    start = time.perf_counter()
+    node = None
+    try:
+        node, reply = prepare_reply(event, host)
+        send_reply(event, event.user_id, reply)
+    finally:
+        metrics.intent_seconds.observe(time.perf_counter() - start, node or "fallback")
+    return "OK2"
 
-    elif event.message.text == "四宿二樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/4-2.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "四宿三樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/4-3.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+def prepare_reply(event, host):
+    """
+    送出之前的部分 (app 與 asgi 共用)：選擇文字訊息的回覆，並記下使用者這次到達的節點
+    回傳 (node, reply)，node 為到達的節點名稱，沒有對應的節點時為 None
+    """
+    user = event.user_id
+    graph = intents.current()
+    text = event.text
+    # 只正規化一次，選回覆、記錄位置與統計都用同一個結果
+    match = graph.match(text)
+    node = match.node.name if match.node is not None else None
+    if sessions is None or user is None:
+        reply = graph.reply_for(text, host, match=match)
+    else:
+        # 依使用者上一步到達的節點選擇回覆，再記下這次到達的節點
+        last = sessions.get(user)
+        previous = last.node if last is not None else None
+        reply = graph.reply_for(text, host, previous, match=match)
+        sessions.put(user, node)
+    return node, reply
 
-    elif event.message.text == "四宿四樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/4-4.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
 
-    elif event.message.text == "四宿五樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/4-5.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+def send_reply(event, user, reply):
+    if push_if_expired(event, user, reply):
+        return
+    try:
+        if RAW_REPLY:
+            replies.reply_raw(line_bot_api, event.reply_token, reply.payload)
+        else:
+            line_bot_api.reply_message(event.reply_token, messages=reply.messages)
+    except LineBotApiError as e:
+        if not push_if_rejected(user, reply, e):
+            raise
+
+
+def push_if_expired(event, user, reply):
+    """reply token 多半已經過期時直接改用 push，有交給 push 佇列時回傳 True"""
+    if push_queue is None or user is None:
+        return False
+    if not push.reply_expired(event, REPLY_TOKEN_TTL):
+        return False
+    push_queue.submit(user, reply)
+    return True
+
+
+def push_if_rejected(user, reply, error):
+    """LINE 回覆 reply token 無效時改用 push，有交給 push 佇列時回傳 True"""
+    if push_queue is None or user is None:
+        return False
+    if not push.is_invalid_reply_token(error):
+        return False
+    push_queue.submit(user, reply)
+    return True
+
+
+def admit_events(events, host):
+    """
+    對訊息事件套用限流，超過的訊息丟掉，每個使用者只回覆一次「請慢一點」
+    回傳 (可以處理的事件, [(event, 「請慢一點」的回覆)])，回覆由呼叫端送出 (app 與 asgi 共用)
+    """
+    admitted = []
+    warnings = []
+    for event in events:
+        user = event.user_id
+        if event.type != "message":
+            # follow / unfollow 不能丟掉，否則取消追蹤的人還會收到公告
+            admitted.append(event)
+        elif inbound_limiter.check(user) is None:
+            admitted.append(event)
+        elif inbound_limiter.should_warn(user):
+            reply = intents.current().throttled_reply(host)
+            if reply is not None:
+                warnings.append((event, reply))
+    return admitted, warnings
+
+
+def send_warnings(warnings):
+    for event, reply in warnings:
+        try:
+            send_reply(event, event.user_id, reply)
+        except Exception:
+            app.logger.exception("送出限流回覆失敗")
+
+
+# 收到的事件限流：RATE_LIMIT=memory (預設，各 worker 各自計算)、sqlite (所有 worker 共用) 或 off
+inbound_limiter = None
+if os.environ.get("RATE_LIMIT", ratelimit.MEMORY) != "off":
+    limiter = functools.partial(
+        ratelimit.create,
+        os.environ.get("RATE_LIMIT", ratelimit.MEMORY),
+        path=os.environ.get("RATE_LIMIT_PATH")
+        or os.path.join(tempfile.gettempdir(), "dromnet-ratelimit.sqlite3"),
+    )
+    global_rate = float(os.environ.get("GLOBAL_RATE", 50))
+    inbound_limiter = ratelimit.InboundLimiter(
+        per_user=limiter(
+            float(os.environ.get("USER_RATE", 1)),
+            float(os.environ.get("USER_BURST", 5)),
+            prefix="user",
+        ),
+        overall=limiter(
+            global_rate, float(os.environ.get("GLOBAL_BURST", 100)), prefix="global"
+        )
+        if global_rate > 0
+        else None,
+        # 每個使用者多久最多回覆一次「請慢一點」
+        warn=limiter(
+            1 / float(os.environ.get("SLOW_DOWN_INTERVAL", 60)), 1, prefix="warn"
+        ),
+    )
 
-    elif event.message.text == "四宿六樓":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/hinet/4-6.jpeg"
-        )
-        alert_message = TextSendMessage(
-            text=f"請找到同寢室的「HN 帳號」，\n並在後面加上「@hinet.net」\n{utils.Separate(10)} \n範例：1501房為 72186749，\n那帳號就是「72186749@hinet.net」，\n密碼全校宿舍皆為：「123456」。"
-        )
-        buttons_template_message = utils.ButtonWindow(
-            title="請根據上則訊息尋找連線帳號密碼：",
-            context="請選擇下列選項。",
-            number=3,
-            label_list=["連線教學", "網路報修", "重新選擇宿舍"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[image_message, alert_message, buttons_template_message],
-        )
+# 重送 webhook 的去重：DEDUPE=memory (預設)、sqlite (所有 worker 共用) 或 off
+dedupe_store = None
+if os.environ.get("DEDUPE", dedupe.MEMORY) != "off":
+    dedupe_store = dedupe.create(
+        os.environ.get("DEDUPE", dedupe.MEMORY),
+        path=os.environ.get("DEDUPE_PATH")
+        or os.path.join(tempfile.gettempdir(), "dromnet-dedupe.sqlite3"),
+        ttl=float(os.environ.get("DEDUPE_TTL", 3600)),
+        maxsize=int(os.environ.get("DEDUPE_MAX", 10000)),
+    )
 
-    elif (
-        event.message.text == "查詢網路帳號密碼"
-        or event.message.text == "不知道帳號密碼"
-        or event.message.text == "重新選擇宿舍"
-    ):
-        confirm_template_message = utils.ConfirmWindow(
-            context="請問您是屬於？", success_string="男生宿舍", error_string="女生宿舍"
-        )
-        line_bot_api.reply_message(event.reply_token, confirm_template_message)
-
-    # options: Windows, macOS, 連線教學
-    elif event.message.text == "連線教學":
-        buttons_template_message = utils.ButtonWindow(
-            title="請問您的電腦系統為何？",
-            context="請選擇下面的選項。",
-            number=2,
-            label_list=["Windows", "macOS"],
-        )
-        line_bot_api.reply_message(event.reply_token, buttons_template_message)
-    # options: Windows 7, Windows 8, Windows 10
-    elif event.message.text == "Windows":
-        buttons_template_message = utils.ButtonWindow(
-            title="請問是 Windows 的哪個版本呢？",
-            context="請選擇下面的選項。",
-            number=3,
-            label_list=["Windows 7", "Windows 8", "Windows 10"],
-        )
-        line_bot_api.reply_message(event.reply_token, buttons_template_message)
-    # options: 網路帳號密碼查詢,
-    elif event.message.text == "Windows 7" or event.message.text == "Windows 8":
-        # TODO userId 取法, github issue https://github.com/line/line-bot-sdk-python/issues/139
-        user = event.source.user_id
-        text = "網路設定步驟如下：\n開啟【控制台】>【網路和網際網路】的【檢視網際狀態及工作】>【設定新的連線與網路】>【選擇連線到網際網路】>【下一步】>【寬頻(PPPOE)】 > 輸入使用者帳號及密碼。"
-        carousel_template_message = TemplateSendMessage(
-            alt_text="歡迎使用中華大學宿網會的簡易小機器人, 請至手機查看訊息。",
-            template=CarouselTemplate(
-                columns=[
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/7_0.png",
-                        title="Win7：進入控制台",
-                        text="如上圖所示，\n點擊「Windows按鍵」後左鍵點擊「控制台」。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/7_0.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/7_1.png",
-                        title="第一步：檢視網際狀態及工作",
-                        text="如上圖所示。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/7_1.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/7_2.png",
-                        title="第二步：設定新的網路連線",
-                        text="如上圖所示，直接設定新連線。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/7_2.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/7_3.png",
-                        title="第四步：點擊連線到網際網路",
-                        text="如上圖所示，點擊「連線到網際網路」，點選下一步。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/7_3.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/7_4.png",
-                        title="第五步：選擇寬頻連線(PPPOE)",
-                        text="如上圖所示，點擊寬頻(PPPOE)。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/7_4.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/7_5.png",
-                        title="第六步：輸入連線的HN帳號及密碼",
-                        text="如上圖所示，輸入HN帳號及密碼，若忘記可以到下面點選「不知道帳號密碼」。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/7_5.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/7_6.png",
-                        title="第七步：確認畫面及測試",
-                        text="如上圖所示，出現了「連線已經可以使用」，可以將瀏覽器打開，測試是否能上網。不能請點選「我需要協助」。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/7_6.png",
-                            ),
-                        ],
-                    ),
-                ]
-            ),
-        )
-        if event.message.text == "Windows 8":
-            text += "\nWindows 8 進入控制台方式，可以參考：\nhttps://dotblogs.com.tw/chou/2012/06/13/72763\n進入控制台請跳至下方第一步。"
-        confirm_template_message = utils.ButtonWindow(
-            title="請問有解決你的問題嗎？",
-            context="請選擇下面的選項。",
-            number=3,
-            label_list=["不知道帳號密碼", "我需要協助", "已完成"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[
-                carousel_template_message,
-                TextSendMessage(text),
-                confirm_template_message,
-            ],
-        )
-    # options: 網路帳號密碼查詢,
-    elif event.message.text == "Windows 10":
-        user = event.source.user_id
-        carousel_template_message = TemplateSendMessage(
-            alt_text="歡迎使用中華大學宿網會的簡易小機器人, 請至手機查看訊息。",
-            template=CarouselTemplate(
-                columns=[
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/10_0.png",
-                        title="第一步：進入連線設定頁面",
-                        text="如上圖所示，\n右鍵點擊「網路圖示」，選取「開啟網路和網際網路設定」。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/10_0.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/10_1.png",
-                        title="第二步：使用網路線接上電腦",
-                        text="如上圖所示，\n插上網路線後，點擊撥號。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/10_1.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/10_2.png",
-                        title="第三步：設定新連線",
-                        text="如上圖所示，直接設定新連線。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/10_2.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/10_3.png",
-                        title="第四步：點擊連線到網際網路",
-                        text="如上圖所示，點擊「連線到網際網路」。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/10_3.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/10_4.png",
-                        title="第五步：選擇寬頻連線(PPPOE)",
-                        text="如上圖所示，點擊寬頻(PPPOE)。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/10_4.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/10_5.png",
-                        title="第六步：輸入連線的HN帳號及密碼",
-                        text="如上圖所示，輸入HN帳號及密碼，若忘記可以到下面點選「不知道帳號密碼」。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/10_5.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/win/10_6.png",
-                        title="第七步：確認畫面及測試",
-                        text="如上圖所示，出現了「您已連線到網際網路」，可以將瀏覽器打開，測試是否能上網。不能請點選「我需要協助」。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/win/10_6.png",
-                            ),
-                        ],
-                    ),
-                ]
-            ),
-        )
-        text = "網路設定步驟如下：\n右鍵點擊【網路圖示】> 左鍵點擊【開啟網路和網際網路設定】>【撥號】>【設定新的連線】>【連線到網際網路】>【寬頻(PPPOE)】> 【輸入連線的HN帳號及密碼】。"
-        confirm_template_message = utils.ButtonWindow(
-            title="請問有解決你的問題嗎？",
-            context="請選擇下面的選項。",
-            number=3,
-            label_list=["不知道帳號密碼", "我需要協助", "已完成"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[
-                carousel_template_message,
-                TextSendMessage(text),
-                confirm_template_message,
-            ],
-        )
-    # options: 網路帳號密碼查詢,
-    elif event.message.text == "macOS":
-        user = event.source.user_id
-        carousel_template_message = TemplateSendMessage(
-            alt_text="歡迎使用中華大學宿網會的簡易小機器人, 請至手機查看訊息。",
-            template=CarouselTemplate(
-                columns=[
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/mac/m1.png",
-                        title="第一步：點擊網路偏好服務",
-                        text="如上圖所示，\n滑鼠移至 WIFI 圖示左鍵點擊後，\n再點選網路偏好服務。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/mac/m1.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/mac/m2.png",
-                        title="第二步：建立 PPPOE 服務",
-                        text="插上轉接器後，才會跳出此畫面。\n接者如上圖所示：\n點選設定IPv4 > 建立 PPPOE 服務。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/mac/m2.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/mac/m3.png",
-                        title="第三步：輸入網路帳號密碼",
-                        text="如上圖所示，輸入HN帳號名稱及密碼，\n不知道帳號可以點擊下面「不知道帳號密碼」",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/mac/m3.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/mac/m4.png",
-                        title="第四步：完成連線",
-                        text="點擊連線後，就可以正常使用連線囉！\n如果還是不能使用，\n請點擊下面「我需要協助」。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/mac/m4.png",
-                            ),
-                        ],
-                    ),
-                ]
-            ),
-        )
-        text = "網路設定步驟如下：\n【左上角蘋果圖示】>【系統偏好設定】>【網路】>【插上轉接頭】>【點擊左側 USB】>【點擊右側 IPv4】> 【建立 PPPOE 服務】> 【輸入HN帳號及密碼】> 【點擊連線】。"
-        confirm_template_message = utils.ButtonWindow(
-            title="請問有解決你的問題嗎？",
-            context="請選擇下面的選項。",
-            number=3,
-            label_list=["不知道帳號密碼", "我需要協助", "已完成"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[
-                carousel_template_message,
-                TextSendMessage(text),
-                confirm_template_message,
-            ],
-        )
-    # over: 已完成連線
-    elif event.message.text == "已完成":
-        text = "很高興你已經可以使用宿舍網路了！\n我們下次見～"
-        buttons_template_message = utils.ButtonWindow(
-            title="請選擇下一步：",
-            context="你下一步要去哪呢？",
-            number=3,
-            label_list=["回到一開始", "我需要協助", "連線教學"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[TextSendMessage(text), buttons_template_message],
-        )
-    # options: 使用者需要協助的部分
-    elif event.message.text == "我需要協助":
-        buttons_template_message = utils.ButtonWindow(
-            title="請問要如何協助你呢？",
-            context="請選擇下面的選項，\n目前有兩種方式。",
-            number=2,
-            label_list=["網路報修", "宿網會"],
-        )
-        line_bot_api.reply_message(event.reply_token, buttons_template_message)
-    elif event.message.text == "網路報修":
-        carousel_template_message = TemplateSendMessage(
-            alt_text="歡迎使用中華大學宿網會的簡易小機器人, 請至手機查看訊息。",
-            template=CarouselTemplate(
-                columns=[
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/fix/01.png",
-                        title="第一步：進入學生資訊系統",
-                        text="如上圖所示。進入學校首頁, 前往學生資訊系統。下方按鈕可以直接前往。（建議搭配電腦使用）",
-                        actions=[
-                            URIAction(
-                                label="前往學生資訊系統",
-                                uri=f"https://student2.chu.edu.tw/",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/fix/02.png",
-                        title="第二步：登入學生資訊系統",
-                        text="如上圖所示。\n輸入帳號及密碼。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/fix/02.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/fix/03.png",
-                        title="第三步：點擊學生宿舍報修系統",
-                        text="如上圖所示。\n【左方導航列】 >【學務系統】>【學生宿舍報修系統】。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/fix/03.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/fix/04.png",
-                        title="第四步：點擊宿舍報修",
-                        text="如上圖所示。\n【上方導航列】 >【宿舍報修&報修查詢】>【宿舍報修】。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/fix/04.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/fix/05.png",
-                        title="第五步：填寫報修申請表",
-                        text="如上圖所示。\n建議使用大圖觀看，請將需求填寫詳細，並留下地點資訊。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/fix/05.png",
-                            ),
-                        ],
-                    ),
-                    CarouselColumn(
-                        thumbnail_image_url=f"{host}/static/img/fix/local.jpg",
-                        title="需要尋找我們？",
-                        text="我們的辦公室如上圖所示。\n位於三宿(萊爾富那一棟)，男生宿舍大門右手邊。",
-                        actions=[
-                            URIAction(
-                                label="點我，觀看完整圖片",
-                                uri=f"{host}/static/img/fix/local.jpg",
-                            ),
-                        ],
-                    ),
-                ]
-            ),
-        )
-        ConfirmWindow = utils.ConfirmWindow(
-            context="請問解決你的問題了嗎？", success_string="需要協助", error_string="已完成"
-        )
-        line_bot_api.reply_message(
-            event.reply_token, messages=[carousel_template_message, ConfirmWindow]
-        )
-    elif event.message.text == "宿網會" or event.message.text == "需要協助":
-        image_message = utils.ImageWindow(
-            origin_path=f"{host}/static/img/fix/local.jpg"
-        )
-        text_message = "服務時間：\n每週一至週四，20:00 至 21:30。\n=\n服務地點：三宿管制門右手邊(萊爾富那棟)\n若不知道位置請看上圖。\n=\n注意：請務必敲門後開門。\n=\n無人回應請用網路報修，我們會於服務時間處理！"
-        buttons_template_message = utils.ButtonWindow(
-            title="請選擇下一步：",
-            context="你下一步要去哪呢？",
-            number=3,
-            label_list=["回到一開始", "我需要協助", "連線教學"],
-        )
-        line_bot_api.reply_message(
-            event.reply_token,
-            messages=[
-                image_message,
-                TextSendMessage(text_message),
-                buttons_template_message,
-            ],
-        )
-    elif event.message.text == "意見回饋":
-        text_message = "意見回饋的表單連結：\nhttps://docs.google.com/forms/d/e/1FAIpQLScXU84AoLYkc7iVM6-KJNzRJsjFrLL8yCUydbH2Vj3PtWN_7Q/viewform"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text_message))
-    else:
-        text_message = TextSendMessage(
-            text="請點擊下方功能選單按鈕使用機器人。\n",
-            quick_reply=QuickReply(
-                items=[
-                    QuickReplyButton(action=MessageAction(label="我是新生 👋", text="新生")),
-                    QuickReplyButton(
-                        action=MessageAction(label="查詢網路帳號密碼", text="查詢網路帳號密碼")
-                    ),
-                    QuickReplyButton(action=MessageAction(label="連線教學 👌", text="連線教學")),
-                    QuickReplyButton(
-                        action=MessageAction(label="我需要協助 🤝", text="我需要協助")
-                    ),
-                    QuickReplyButton(action=MessageAction(label="意見回饋", text="意見回饋")),
-                ]
-            ),
-        )
-        line_bot_api.reply_message(event.reply_token, text_message)
-    return "OK2"
+# 使用者在對話流程中的位置：SESSIONS=memory (預設)、sqlite (所有 worker 共用) 或 off
+sessions = None
+if os.environ.get("SESSIONS", session.MEMORY) != "off":
+    sessions = session.create(
+        os.environ.get("SESSIONS", session.MEMORY),
+        path=os.environ.get("SESSION_PATH")
+        or os.path.join(tempfile.gettempdir(), "dromnet-session.sqlite3"),
+        ttl=float(os.environ.get("SESSION_TTL", 1800)),
+        maxsize=int(os.environ.get("SESSION_MAX", 10000)),
+    )
+
+# 公告的收件人，FOLLOWERS=off 時不收集
+followers = None
+if os.environ.get("FOLLOWERS") != "off":
+    followers = announce.FollowerStore(
+        os.environ.get("FOLLOWERS_PATH", announce.DEFAULT_FOLLOWERS_PATH)
+    )
+
+announcer = announce.Announcer(
+    line_bot_api,
+    ratelimit.TokenBucket(float(os.environ.get("ANNOUNCE_RATE", 20))),
+    checkpoint_path=os.environ.get(
+        "ANNOUNCE_CHECKPOINT", announce.DEFAULT_CHECKPOINT_PATH
+    ),
+)
+
+# reply token 過期時改用 push 送出 (會用掉訊息額度)，PUSH_FALLBACK=0 時關閉
+REPLY_TOKEN_TTL = float(os.environ.get("REPLY_TOKEN_TTL", 50))
+push_queue = None
+if os.environ.get("PUSH_FALLBACK", "1") != "0":
+    push_queue = push.PushQueue(
+        line_bot_api,
+        ratelimit.TokenBucket(float(os.environ.get("PUSH_RATE", 20))),
+        interval=float(os.environ.get("PUSH_INTERVAL", 0.5)),
+    )
+
+# 同一個 webhook 有多個事件時同時處理
+event_fanout = background.EventFanout(
+    max_workers=int(os.environ.get("EVENT_WORKERS", 4)),
+    deadline=float(os.environ.get("EVENT_DEADLINE", 5)),
+)
+
+# ASYNC_REPLY=1 時驗證簽章後先回 200 給 LINE，回覆交給背景 thread 送出
+reply_queue = None
+if os.environ.get("ASYNC_REPLY") == "1":
+    reply_queue = background.ReplyQueue(
+        lambda item: handle_events(*item),
+        workers=int(os.environ.get("REPLY_WORKERS", 4)),
+        maxsize=int(os.environ.get("REPLY_QUEUE_SIZE", 100)),
+        policy=os.environ.get("REPLY_QUEUE_POLICY", background.DROP_OLDEST),
+    )
+
+
+# =========== /metrics ===========
+def queue_depths():
+    depths = {}
+    if reply_queue is not None:
+        depths[("reply",)] = reply_queue.depth
+    if push_queue is not None:
+        depths[("push",)] = push_queue.depth
+    return depths
+
+
+def queue_dropped():
+    dropped = {}
+    if reply_queue is not None:
+        dropped[("reply",)] = reply_queue.dropped + reply_queue.rejected
+    if push_queue is not None:
+        dropped[("push",)] = push_queue.dropped
+    return dropped
+
+
+def cache_counts():
+    """{(cache, result): 次數}，result 為 hit 或 miss"""
+    # fork 之後也會呼叫 (見 metrics._Callback)，用 loaded 才不會在那時啟動檢查檔案的 thread
+    graph = intents.store.loaded
+    counts = {
+        ("replies", "hit"): graph.registry.hits,
+        ("replies", "miss"): graph.registry.misses,
+        ("resize", "hit"): resize_cache.hits,
+        ("resize", "miss"): resize_cache.misses,
+    }
+    if graph.suggester is not None:
+        info = graph.suggester.cache_info()
+        counts[("suggestions", "hit")] = info.hits
+        counts[("suggestions", "miss")] = info.misses
+    if dedupe_store is not None:
+        counts[("dedupe", "hit")] = dedupe_store.hits
+        counts[("dedupe", "miss")] = dedupe_store.checks - dedupe_store.hits
+    return counts
+
+
+def ratelimit_counts():
+    if inbound_limiter is None:
+        return {}
+    return {
+        ("allowed",): inbound_limiter.allowed,
+        ("user",): inbound_limiter.limited_user,
+        ("global",): inbound_limiter.limited_global,
+    }
+
+
+def event_errors():
+    return {
+        ("failed",): event_fanout.failed,
+        ("timed_out",): event_fanout.timed_out,
+    }
+
+
+def push_counts():
+    if push_queue is None:
+        return {}
+    return {("sent",): push_queue.sent, ("failed",): push_queue.failed}
+
+
+metrics.registry.gauge_func(
+    "dromnet_queue_depth", "佇列中等待處理的數量", queue_depths, ["queue"]
+)
+metrics.registry.counter_func(
+    "dromnet_queue_dropped_total", "佇列滿時丟掉或拒絕的數量", queue_dropped, ["queue"]
+)
+metrics.registry.counter_func(
+    "dromnet_cache_total", "各快取命中與未命中的次數", cache_counts, ["cache", "result"]
+)
+metrics.registry.counter_func(
+    "dromnet_ratelimit_total", "收到的事件限流結果", ratelimit_counts, ["result"]
+)
+metrics.registry.counter_func(
+    "dromnet_slow_down_total",
+    "回覆「請慢一點」的次數",
+    lambda: inbound_limiter.warned if inbound_limiter is not None else 0,
+)
+metrics.registry.counter_func(
+    "dromnet_redeliveries_total",
+    "LINE 重送的事件數 (isRedelivery)",
+    lambda: dedupe_store.redeliveries if dedupe_store is not None else 0,
+)
+metrics.registry.counter_func(
+    "dromnet_event_errors_total",
+    "處理失敗或超過 EVENT_DEADLINE 仍未完成的事件數",
+    event_errors,
+    ["reason"],
+)
+metrics.registry.counter_func(
+    "dromnet_push_total", "改用 push 送出的使用者數", push_counts, ["result"]
+)
 
 
 if __name__ == "__main__":
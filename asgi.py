@@ -0,0 +1,400 @@
+"""
+ASGI 版本的入口，與 app:app 使用同一份設定與對話內容
+
+    uvicorn asgi:app --workers 2
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+/callback 以 async 處理：驗證簽章、去重、限流、選擇回覆與記錄使用者的位置都直接呼叫 app.py 的函式
+(admit_events、prepare_reply、push_if_expired 等)，這裡只有送出的部分是 async，
+會寫入 SQLite 的步驟 (追蹤者，以及用 sqlite 時的去重、限流、使用者位置) 在 thread pool 裡執行；
+回覆用 Reply.payload 組好 request body，經由共用連線池的 aiohttp ClientSession 送出。
+等 LINE API 回應時不佔用 thread，一個 process 可以同時有數百個回覆在路上。
+其他路徑 (首頁、圖片、/admin、/metrics) 交給 app.py 的 Flask app，在 thread pool 裡執行。
+
+需要另外安裝 aiohttp 與 uvicorn；line-bot-sdk 1.19 沒有 async 的 API client。
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+from linebot import LineBotApi
+from linebot.__about__ import __version__ as sdk_version
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+
+import app as wsgi
+import dedupe
+import fastparse
+import intents
+import metrics
+import ratelimit
+import replies
+import session
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLineBotApi:
+    """
+    送出 reply 的 async LINE API client，所有請求共用一個 aiohttp ClientSession
+
+    session 在第一次送出時才建立並綁定當下的 event loop，fork 出的 worker 各自一個。
+    LINE 回覆錯誤時與 SDK 一樣丟出 LineBotApiError，連線失敗時丟出 aiohttp.ClientError 或 asyncio.TimeoutError。
+
+    :params timeout: (連線, 讀取) 逾時秒數，等待連線池空出連線的時間不算在內
+    :params pool_size: 最多同時開啟的連線數
+    :params max_inflight: 最多同時送出 (含等待連線) 的請求數，超過的請求在 semaphore 上等待
+    :params on_response: on_response(method, url, status_code, seconds)，連線失敗時 status_code 為 None
+    """
+
+    def __init__(
+        self,
+        channel_access_token,
+        endpoint=LineBotApi.DEFAULT_API_ENDPOINT,
+        timeout=(3.05, 10),
+        pool_size=500,
+        max_inflight=1000,
+        on_response=None,
+    ):
+        self.endpoint = endpoint
+        self.headers = {
+            "Authorization": "Bearer " + channel_access_token,
+            "User-Agent": "line-bot-sdk-python/" + sdk_version,
+        }
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=timeout[0], sock_read=timeout[1]
+        )
+        self.pool_size = pool_size
+        self.max_inflight = max_inflight
+        self.on_response = on_response
+        self.inflight = 0
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+
+    def _ensure_session(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                headers=self.headers,
+                timeout=self.timeout,
+            )
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+            self._loop = loop
+        return self._session
+
+    async def post(self, path, body, headers=None):
+        """
+        :params body: request body (bytes)
+        """
+        session = self._ensure_session()
+        url = self.endpoint + path
+        self.inflight += 1
+        try:
+            async with self._semaphore:
+                status = None
+                start = time.perf_counter()
+                try:
+                    async with session.post(
+                        url, data=body, headers=headers
+                    ) as response:
+                        status = response.status
+                        content = await response.read()
+                        response_headers = dict(response.headers)
+                finally:
+                    if self.on_response is not None:
+                        self.on_response(
+                            "POST", url, status, time.perf_counter() - start
+                        )
+        finally:
+            self.inflight -= 1
+        if not 200 <= status < 300:
+            try:
+                error = json.loads(content)
+            except ValueError:
+                error = {"message": content.decode("utf-8", "replace")}
+            raise LineBotApiError(
+                status_code=status,
+                headers=response_headers,
+                request_id=response_headers.get("X-Line-Request-Id"),
+                accepted_request_id=response_headers.get("X-Line-Accepted-Request-Id"),
+                error=Error.new_from_json_dict(error),
+            )
+        return status
+
+    async def reply(self, reply_token, payload, notification_disabled=False):
+        """
+        :params payload: Reply.payload，messages 的 JSON array (bytes)
+        """
+        return await self.post(
+            replies.REPLY_PATH,
+            replies.reply_body(reply_token, payload, notification_disabled),
+            headers={"Content-Type": "application/json; charset=UTF-8"},
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            self._loop = None
+
+
+line_api = AsyncLineBotApi(
+    os.environ.get("CHANNEL_ACCESS_TOKEN"),
+    endpoint=wsgi.line_bot_api.endpoint,
+    timeout=(
+        float(os.environ.get("LINE_CONNECT_TIMEOUT", 3.05)),
+        float(os.environ.get("LINE_READ_TIMEOUT", 10)),
+    ),
+    pool_size=int(os.environ.get("LINE_POOL_SIZE", 500)),
+    max_inflight=int(os.environ.get("ASGI_MAX_INFLIGHT", 1000)),
+    on_response=metrics.record_line_api,
+)
+# 等待同一個 webhook 所有事件處理完成的秒數，時間到就先回 200，沒做完的繼續在背景執行
+EVENT_DEADLINE = float(os.environ.get("EVENT_DEADLINE", 5))
+# 用 sqlite 的步驟會等磁碟 (每則訊息寫入、限流的 BEGIN IMMEDIATE 最多等 5 秒)，改在 thread pool 執行
+DEDUPE_BLOCKING = os.environ.get("DEDUPE", dedupe.MEMORY) == dedupe.SQLITE
+RATE_LIMIT_BLOCKING = os.environ.get("RATE_LIMIT", ratelimit.MEMORY) == ratelimit.SQLITE
+SESSIONS_BLOCKING = os.environ.get("SESSIONS", session.MEMORY) == session.SQLITE
+
+metrics.registry.gauge_func(
+    "dromnet_line_api_inflight",
+    "正在送出 (含等待連線) 的 LINE API 請求數，只有 ASGI 模式",
+    lambda: line_api.inflight,
+)
+
+
+# =========== /callback ===========
+async def callback(scope, receive, send):
+    headers = dict(scope["headers"])
+    signature = headers.get(b"x-line-signature")
+    if signature is None:
+        await respond(send, 400, b"Bad Request")
+        return
+    body = await read_body(receive)
+    if wsgi.app.logger.isEnabledFor(logging.INFO):
+        wsgi.app.logger.info("Request body: " + body.decode("utf-8", "replace"))
+    with metrics.signature_seconds.time():
+        valid = fastparse.verify(body, signature.decode("latin-1"), wsgi.channel_secret)
+    if not valid:
+        metrics.signature_failures.inc()
+        print(
+            "Invalid signature. Please check your channel access token/channel secret."
+        )
+        await respond(send, 400, b"Bad Request")
+        return
+    events = fastparse.events(body)
+
+    if wsgi.dedupe_store is not None:
+        # 重送的事件已經處理過，直接回 200 不再回覆
+        events = await run_sync(
+            DEDUPE_BLOCKING, dedupe.unique_events, wsgi.dedupe_store, events
+        )
+
+    host = request_host(scope, headers)
+    if wsgi.inbound_limiter is not None:
+        events, warnings = await run_sync(
+            RATE_LIMIT_BLOCKING, wsgi.admit_events, events, host
+        )
+        await send_warnings(warnings)
+    await handle_events(events, host)
+    await respond(send, 200, b"OK")
+
+
+async def run_sync(blocking, func, *args):
+    """blocking 時在 thread pool 執行 func(*args)，不卡住 event loop；否則直接執行"""
+    if not blocking:
+        return func(*args)
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+def request_host(scope, headers):
+    """與 app.request_host 相同，取 Host header 的主機名稱 (不含 port)"""
+    host = headers.get(b"host")
+    if host is not None:
+        hostname = urlsplit("//" + host.decode("latin-1")).hostname
+    else:
+        hostname = (scope.get("server") or ("localhost", None))[0]
+    return f"https://{hostname}"
+
+
+async def handle_events(events, host):
+    """
+    不同使用者的事件同時處理，同一個使用者的事件依序處理 (與 app.handle_events 相同)，
+    最多等 EVENT_DEADLINE 秒，單一事件失敗只會記錄下來
+    """
+    if not events:
+        return
+    groups = {}
+    for event in events:
+        groups.setdefault(event.user_id, []).append(event)
+    tasks = [
+        asyncio.ensure_future(handle_all(group, host)) for group in groups.values()
+    ]
+    _, pending = await asyncio.wait(tasks, timeout=EVENT_DEADLINE)
+    if pending:
+        logger.warning("%d 組事件在 %s 秒內沒有處理完", len(pending), EVENT_DEADLINE)
+
+
+async def handle_all(events, host):
+    for event in events:
+        try:
+            await handle_event(event, host)
+        except Exception:
+            logger.exception("處理事件失敗")
+
+
+async def handle_event(event, host):
+    """與 app.handle_event 相同，追蹤者寫入 SQLite 的部分在 thread pool 裡執行，不卡住 event loop"""
+    if wsgi.followers is not None and event.user_id is not None:
+        await run_sync(True, wsgi.record_follower, event)
+    if event.text is not None:
+        await handle_message(event, host)
+
+
+async def handle_message(event, host):
+    start = time.perf_counter()
+    node = None
+    try:
+        node, reply = await run_sync(SESSIONS_BLOCKING, wsgi.prepare_reply, event, host)
+        await send_reply(event, event.user_id, reply)
+    finally:
+        metrics.intent_seconds.observe(time.perf_counter() - start, node or "fallback")
+
+
+async def send_reply(event, user, reply):
+    """與 app.send_reply 相同，只有送出的部分改用 async"""
+    if wsgi.push_if_expired(event, user, reply):
+        return
+    try:
+        await line_api.reply(event.reply_token, reply.payload)
+    except LineBotApiError as e:
+        if not wsgi.push_if_rejected(user, reply, e):
+            raise
+
+
+async def send_warnings(warnings):
+    for event, reply in warnings:
+        try:
+            await send_reply(event, event.user_id, reply)
+        except Exception:
+            logger.exception("送出限流回覆失敗")
+
+
+# =========== 其他路徑交給 Flask ===========
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope["http_version"],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-length":
+            continue
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+            continue
+        key = "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def run_wsgi(environ):
+    """在 thread 裡執行 Flask app，回傳 (status, headers, body)"""
+    response = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers
+        ]
+        return chunks.append
+
+    result = wsgi.app(environ, start_response)
+    try:
+        for chunk in result:
+            chunks.append(chunk)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], b"".join(chunks)
+
+
+async def call_wsgi(scope, receive, send):
+    body = await read_body(receive)
+    status, headers, content = await asyncio.get_event_loop().run_in_executor(
+        None, run_wsgi, wsgi_environ(scope, body)
+    )
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    if scope["method"] == "HEAD":
+        content = b""
+    await send({"type": "http.response.body", "body": content})
+
+
+# =========== ASGI ===========
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def respond(send, status, body):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await line_api.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] != "http":
+        raise ValueError(f"不支援的連線類型：{scope['type']}")
+    elif scope["path"] == "/callback" and scope["method"] == "POST":
+        await callback(scope, receive, send)
+    else:
+        await call_wsgi(scope, receive, send)
@@ -0,0 +1,306 @@
+"""
+靜態圖片的縮圖與壓縮
+
+建置時執行 `python assets.py build`，把 static/img 底下的圖片轉成
+幾種大小的 JPEG 放到 static/img/_build，並寫出 manifest.json。
+執行時 variant_url 依 manifest 把原圖網址換成對應的版本，
+沒有 manifest (例如本機開發沒先建置) 時一律回傳原圖網址。
+
+送出的網址會再加上內容的 hash (/assets/hinet/1-2.<hash>.jpg)，
+內容不變網址就不變，所以可以讓 LINE 與瀏覽器永久快取。
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+IMG_DIR = os.path.join(STATIC_DIR, "img")
+BUILD_DIR = os.path.join(IMG_DIR, "_build")
+MANIFEST_PATH = os.path.join(BUILD_DIR, "manifest.json")
+URL_PREFIX = "/static/img/"
+ASSET_PREFIX = "/assets/"
+# ASSET_FINGERPRINT=0 時送出原本的 /static/img 網址
+FINGERPRINT = os.environ.get("ASSET_FINGERPRINT", "1") != "0"
+HASH_LENGTH = 10
+# 大於 0 時 carousel 縮圖改用 /img/<寬度>/ 即時縮圖，寬度需在 resizer.ALLOWED_WIDTHS 內
+THUMB_RESIZE_WIDTH = int(os.environ.get("THUMB_RESIZE_WIDTH", 0))
+
+# 各版本的最大寬高與 JPEG 品質
+#   full: 點開後看到的完整圖片
+#   thumb: carousel 的 thumbnail_image_url，LINE 限制寬度最多 1024px
+#   preview: 圖片訊息的 preview_image_url，LINE 限制 1MB
+VARIANTS = {
+    "full": ((2048, 2048), 85),
+    "thumb": ((1024, 1024), 80),
+    "preview": ((480, 960), 75),
+}
+SOURCE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+_manifest = None
+# 建置時記錄的 hash 與 manifest.json 的修改時間
+_manifest_hashes = {}
+_manifest_mtime = 0
+# path -> ((mtime, size), hash)
+_hashes = {}
+_manifest_lock = threading.Lock()
+
+
+def load_manifest(path=MANIFEST_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"images": {}, "hashes": {}}
+
+
+def manifest():
+    global _manifest, _manifest_mtime
+    if _manifest is None:
+        with _manifest_lock:
+            if _manifest is None:
+                loaded = load_manifest()
+                try:
+                    _manifest_mtime = os.stat(MANIFEST_PATH).st_mtime_ns
+                except FileNotFoundError:
+                    _manifest_mtime = 0
+                _hashes.clear()
+                _manifest_hashes.clear()
+                _manifest_hashes.update(loaded.get("hashes", {}))
+                _manifest = loaded
+    return _manifest["images"]
+
+
+def reload_manifest():
+    global _manifest
+    with _manifest_lock:
+        _manifest = None
+    manifest()
+
+
+def content_hash(path):
+    """
+    static/img 底下 path 的內容 hash，檔案不存在時回傳 None
+
+    每次都會 stat 檔案：檔案在建置之後 (或上次計算之後) 被覆蓋時重新讀檔計算，
+    舊網址就不會以舊的 hash 送出新的內容。
+    """
+    manifest()
+    full_path = os.path.join(IMG_DIR, path)
+    try:
+        stat = os.stat(full_path)
+    except FileNotFoundError:
+        return None
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _hashes.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    digest = _manifest_hashes.get(path)
+    if digest is None or stat.st_mtime_ns > _manifest_mtime:
+        try:
+            digest = _digest(full_path)[:HASH_LENGTH]
+        except FileNotFoundError:
+            return None
+    _hashes[path] = (stamp, digest)
+    return digest
+
+
+def fingerprinted_path(path):
+    """hinet/1-2.jpeg -> hinet/1-2.<hash>.jpeg，檔案不存在時回傳 None"""
+    digest = content_hash(path)
+    if digest is None:
+        return None
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{digest}{ext}"
+
+
+def resolve_fingerprint(name):
+    """
+    把 fingerprinted_path 的結果拆回 (path, hash)，格式不對時回傳 (None, None)
+    """
+    stem, ext = os.path.splitext(name)
+    stem, dot, digest = stem.rpartition(".")
+    if not dot or len(digest) != HASH_LENGTH:
+        return None, None
+    path = f"{stem}{ext}"
+    full_path = os.path.normpath(os.path.join(IMG_DIR, path))
+    if not full_path.startswith(IMG_DIR + os.sep) or not os.path.isfile(full_path):
+        return None, None
+    return path, digest
+
+
+def asset_url(path, host=""):
+    """static/img 底下 path 對外的網址，找不到檔案時退回原本的 /static/img 網址"""
+    if FINGERPRINT:
+        fingerprinted = fingerprinted_path(path)
+        if fingerprinted is not None:
+            return f"{host}{ASSET_PREFIX}{fingerprinted}"
+        logger.warning("找不到圖片 %s，改用 %s 網址", path, URL_PREFIX)
+    return f"{host}{URL_PREFIX}{path}"
+
+
+def variant_path(path, kind="full"):
+    """
+    回傳 static/img 底下 path 的 kind 版本路徑，沒有對應版本時回傳 path
+
+    :params path: 相對於 static/img 的路徑，例如 hinet/1-2.jpeg
+    :params kind: full、thumb 或 preview
+    """
+    entry = manifest().get(path)
+    if entry is None:
+        return path
+    return entry.get(kind, path)
+
+
+def variant_url(url, kind="full"):
+    """把指向 /static/img/ 的網址換成 kind 版本的 asset_url，其他網址原樣回傳。"""
+    host, sep, path = url.partition(URL_PREFIX)
+    if not sep:
+        return url
+    if kind == "thumb" and THUMB_RESIZE_WIDTH:
+        return resized_url(path, THUMB_RESIZE_WIDTH, host)
+    return asset_url(variant_path(path, kind), host)
+
+
+def resized_url(path, width, host=""):
+    """即時縮圖的網址，v 帶內容 hash，圖片更新後網址跟著變；找不到檔案時退回原本的 /static/img 網址"""
+    digest = content_hash(path)
+    if digest is None:
+        logger.warning("找不到圖片 %s，改用 %s 網址", path, URL_PREFIX)
+        return f"{host}{URL_PREFIX}{path}"
+    return f"{host}/img/{width}/{path}?v={digest}"
+
+
+# =========== 建置 ===========
+
+
+def _files(include_build=False):
+    for root, dirs, files in os.walk(IMG_DIR):
+        dirs[:] = sorted(d for d in dirs if include_build or not d.startswith("_"))
+        for name in sorted(files):
+            if name.lower().endswith(SOURCE_EXTENSIONS + (".webp",)):
+                full_path = os.path.join(root, name)
+                yield os.path.relpath(full_path, IMG_DIR).replace(os.sep, "/")
+
+
+def _sources():
+    for path in _files():
+        if path.lower().endswith(SOURCE_EXTENSIONS):
+            yield path
+
+
+def _digest(full_path):
+    with open(full_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def flatten(image):
+    from PIL import Image
+
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert("RGB")
+
+
+def _save(image, out_path, fmt, quality, screenshot):
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    if fmt == "webp":
+        image.save(out_path, "WEBP", quality=quality, method=6)
+    else:
+        # 截圖 (PNG) 的文字邊緣在色度抽樣後會糊掉，保留完整色度
+        image.save(
+            out_path,
+            "JPEG",
+            quality=quality,
+            optimize=True,
+            progressive=True,
+            subsampling=0 if screenshot else 2,
+        )
+    return os.path.getsize(out_path)
+
+
+def build_image(path, webp=False):
+    from PIL import Image
+
+    src = os.path.join(IMG_DIR, path)
+    src_size = os.path.getsize(src)
+    stem = os.path.splitext(path)[0]
+    entry = {"sha1": _digest(src), "bytes": {"source": src_size}}
+    with Image.open(src) as opened:
+        screenshot = opened.format == "PNG"
+        image = flatten(opened)
+    for kind, (box, quality) in VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail(box, Image.LANCZOS)
+        out = f"_build/{kind}/{stem}.jpg"
+        size = _save(resized, os.path.join(IMG_DIR, out), "jpeg", quality, screenshot)
+        if size >= src_size and resized.size == image.size:
+            # 重新壓縮反而變大，直接用原圖
+            os.remove(os.path.join(IMG_DIR, out))
+            out, size = path, src_size
+        entry[kind] = out
+        entry["bytes"][kind] = size
+        if webp:
+            out = f"_build/{kind}/{stem}.webp"
+            size = _save(resized, os.path.join(IMG_DIR, out), "webp", quality, False)
+            entry.setdefault("webp", {})[kind] = out
+            entry["bytes"][f"{kind}.webp"] = size
+    return entry
+
+
+def build(webp=False, force=False):
+    """建立所有圖片的各個版本，來源沒有變動的圖片沿用上次的結果。"""
+    previous = {} if force else load_manifest().get("images", {})
+    images = {}
+    for path in _sources():
+        old = previous.get(path)
+        if (
+            old is not None
+            and old.get("sha1") == _digest(os.path.join(IMG_DIR, path))
+            and ("webp" in old) == webp
+        ):
+            images[path] = old
+            continue
+        images[path] = build_image(path, webp=webp)
+        sizes = images[path]["bytes"]
+        print(
+            f"{path}: {sizes['source'] // 1024} KB -> "
+            + ", ".join(f"{kind} {sizes[kind] // 1024} KB" for kind in VARIANTS)
+        )
+
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    hashes = {
+        path: _digest(os.path.join(IMG_DIR, path))[:HASH_LENGTH]
+        for path in _files(include_build=True)
+    }
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"version": 1, "images": images, "hashes": hashes},
+            f,
+            ensure_ascii=False,
+            indent=1,
+        )
+    os.replace(tmp_path, MANIFEST_PATH)
+    reload_manifest()
+    return images
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="建立 static/img 的縮圖與壓縮版本")
+    sub = arg_parser.add_subparsers(dest="command")
+    build_parser = sub.add_parser("build")
+    build_parser.add_argument("--webp", action="store_true", help="另外輸出 WebP 版本")
+    build_parser.add_argument("--force", action="store_true", help="忽略上次的結果全部重建")
+    args = arg_parser.parse_args()
+    if args.command == "build":
+        build(webp=args.webp, force=args.force)
+    else:
+        arg_parser.print_help()
@@ -0,0 +1,199 @@
+import atexit
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 佇列滿時的處理方式
+REJECT = "reject"  # 不收新的，讓呼叫端回應 503
+DROP_OLDEST = "drop_oldest"  # 丟掉最舊的，reply token 最可能已經過期
+POLICIES = (REJECT, DROP_OLDEST)
+
+_STOP = object()
+
+
+class ReplyQueue:
+    """
+    有上限的背景工作佇列，由固定數量的 thread 依序取出並執行 worker(item)
+
+    thread 在第一次 submit 時才啟動，gunicorn fork 之後每個 worker 各自一組。
+    程式結束時會先把佇列中剩下的工作做完 (最多等 drain_timeout 秒)。
+
+    :params worker: 處理單一工作的函式
+    :params workers: thread 數量
+    :params maxsize: 佇列上限
+    :params policy: 佇列滿時的處理方式，REJECT 或 DROP_OLDEST
+    """
+
+    def __init__(
+        self, worker, workers=4, maxsize=100, policy=DROP_OLDEST, drain_timeout=10
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的 policy：{policy!r}，可用的有 {POLICIES}")
+        self._worker = worker
+        self._workers = workers
+        self._policy = policy
+        self._drain_timeout = drain_timeout
+        self._queue = queue.Queue(maxsize)
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.dropped = 0
+        self.rejected = 0
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, item):
+        """放入一個工作，被拒絕時回傳 False。"""
+        if self._closed:
+            return False
+        self._ensure_started()
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return True
+            except queue.Full:
+                if self._policy == REJECT:
+                    self.rejected += 1
+                    return False
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+                self.dropped += 1
+                logger.warning("reply queue 已滿，丟棄最舊的一筆工作")
+            except queue.Empty:
+                pass
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = [
+                threading.Thread(target=self._run, name=f"reply-{i}", daemon=True)
+                for i in range(self._workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.shutdown)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._worker(item)
+            except Exception:
+                logger.exception("背景回覆失敗")
+            finally:
+                self._queue.task_done()
+
+    def shutdown(self):
+        """停止接收新工作，等佇列中的工作做完後結束所有 thread。"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + self._drain_timeout
+        try:
+            for _ in self._threads:
+                # STOP 排在剩下的工作之後，佇列滿時等 thread 清出空位
+                self._queue.put(_STOP, timeout=max(0, deadline - time.monotonic()))
+        except queue.Full:
+            logger.warning("reply queue 在時間內沒有清空，剩下 %d 筆工作", self.depth)
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+
+class EventFanout:
+    """
+    把同一個 webhook 裡的多個事件分給 thread pool 同時處理，可以指定要依序處理的同一組事件
+
+    pool 與同時執行的數量都有上限，pool 忙不過來時直接在呼叫端的 thread 執行。
+    最多等 deadline 秒，單一事件失敗只會記錄下來，不影響其他事件。
+
+    :params max_workers: thread 數量
+    :params deadline: 等待所有事件完成的秒數
+    """
+
+    def __init__(self, max_workers=4, deadline=5.0):
+        self._max_workers = max_workers
+        self._deadline = deadline
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.failed = 0
+        self.timed_out = 0
+
+    def _pool(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        self._max_workers, thread_name_prefix="event"
+                    )
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _call(self, func, item):
+        try:
+            func(item)
+        except Exception:
+            self.failed += 1
+            logger.exception("事件處理失敗")
+            return False
+        return True
+
+    def _call_all(self, func, items):
+        return sum(self._call(func, item) for item in items)
+
+    def _release_after(self, func, items):
+        try:
+            return self._call_all(func, items)
+        finally:
+            self._slots.release()
+
+    def run(self, func, items, key=None):
+        """
+        對每個 item 執行 func(item)，回傳成功的數量。
+
+        :params key: key(item) 相同的 item 依原本的順序在同一個 thread 執行
+        """
+        if key is None:
+            groups = [[item] for item in items]
+        else:
+            grouped = {}
+            for item in items:
+                grouped.setdefault(key(item), []).append(item)
+            groups = list(grouped.values())
+        if len(groups) < 2:
+            return sum(self._call_all(func, group) for group in groups)
+
+        deadline = time.monotonic() + self._deadline
+        futures = []
+        ok = 0
+        for group in groups:
+            if self._slots.acquire(blocking=False):
+                futures.append(self._pool().submit(self._release_after, func, group))
+            else:
+                ok += self._call_all(func, group)
+
+        done, not_done = concurrent.futures.wait(
+            futures, timeout=max(0, deadline - time.monotonic())
+        )
+        if not_done:
+            self.timed_out += len(not_done)
+            logger.warning("%d 個事件超過 %s 秒仍未完成", len(not_done), self._deadline)
+        return ok + sum(future.result() for future in done)
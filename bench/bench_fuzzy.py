@@ -0,0 +1,75 @@
+"""
+打錯字建議 (fuzzy.NgramIndex) 的效能測試
+
+    python bench/bench_fuzzy.py [--repeat 2000]
+
+先用 content/flows.json 實際的選項測，再把選項數量放大到上萬個，
+確認查詢時間不會跟著選項數量一直增加。
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flows  # noqa: E402
+from fuzzy import NgramIndex  # noqa: E402
+from normalize import normalize  # noqa: E402
+
+QUERIES = ["二宿三", "windos", "網路報修啦", "帳號密碼", "宿網", "你好", "unknown", "macc"]
+CHARS = "一二三四五六七八九宿樓網路帳號密碼連線教學報修協助新生完成"
+
+
+def entries_of(graph):
+    return [
+        (normalize(text), node.name)
+        for node in graph.nodes.values()
+        for text in node.texts
+    ]
+
+
+def synthetic(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        ("".join(rng.choice(CHARS) for _ in range(rng.randint(3, 10))), f"intent-{i}")
+        for i in range(count)
+    ]
+
+
+def measure(entries, repeat):
+    start = time.perf_counter()
+    index = NgramIndex(entries)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    queries = [normalize(query) for query in QUERIES]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            index.search(query)
+    per_query_us = (time.perf_counter() - start) / (repeat * len(queries)) * 1e6
+    return build_ms, per_query_us
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--repeat", type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    graph = flows.load(
+        os.path.join(os.path.dirname(flows.__file__), "content", "flows.json")
+    )
+    print(f"{'選項數':>8} {'建立 (ms)':>10} {'每次查詢 (us)':>14}")
+    entries = entries_of(graph)
+    build_ms, per_query_us = measure(entries, args.repeat)
+    print(f"{len(entries):>8} {build_ms:>10.2f} {per_query_us:>14.1f}  (flows.json)")
+    for count in (1000, 10000, 50000):
+        build_ms, per_query_us = measure(
+            entries + synthetic(count), max(1, args.repeat // 10)
+        )
+        print(f"{len(entries) + count:>8} {build_ms:>10.2f} {per_query_us:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
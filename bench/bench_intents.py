@@ -0,0 +1,263 @@
+"""
+每個選項建立與送出回覆的效能測試
+
+    python bench/bench_intents.py                 # 與 bench/baseline_intents.json 比較，退步時 exit 1
+    python bench/bench_intents.py --update        # 重新產生 baseline
+    python bench/bench_intents.py --no-time       # 只比較記憶體與 payload 大小 (不受機器快慢影響)
+
+對 content/flows.json 的每個節點 (加上 fallback、打錯字建議與房號) 量測：
+    build：不經過快取重新建立訊息並序列化 (內容重新載入後第一次回覆的成本)
+    sdk / raw：app.handle_message 的時間，REPLY_MODE 分別為預設與 raw，LINE API 的 _post 換成空函式
+    alloc：建立一次回覆時 tracemalloc 的記憶體高峰 (bytes)
+    payload：回覆的 messages JSON 大小 (bytes)
+另外量測 utils 的 ButtonWindow、ConfirmWindow 與 ImageWindow。
+
+時間取多輪中最快的一輪，baseline 取多次量測的中位數；時間超過門檻的項目會重新量測幾次，都超過才算退步。
+時間只能跟同一台機器的 baseline 比較，共用的 CI 機器上可以加 --no-time。換了 Python 或套件版本後請用 --update 重新產生 baseline。
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import timeit
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 關掉會影響量測的功能：push 改道、限流、記錄使用者與寫入統計
+for key, value in {
+    "CHANNEL_ACCESS_TOKEN": "bench",
+    "CHANNEL_SECRET": "bench",
+    "ASSET_FINGERPRINT": "0",
+    "PUSH_FALLBACK": "0",
+    "RATE_LIMIT": "off",
+    "SESSIONS": "off",
+    "FOLLOWERS": "off",
+    "METRICS_DIR": "off",
+}.items():
+    os.environ.setdefault(key, value)
+
+import app  # noqa: E402
+import fastparse  # noqa: E402
+import intents  # noqa: E402
+import utils  # noqa: E402
+from dispatch import Reply  # noqa: E402
+
+HOST = "https://bot.example.com"
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline_intents.json"
+)
+# 除了選項本身，另外量測這幾種輸入
+EXTRA_TEXTS = {"(fallback)": "隨便打打", "(suggestion)": "windos", "(room)": "2301"}
+WINDOWS = {
+    "utils.ButtonWindow": lambda: utils.ButtonWindow(
+        "宿網會", "請選擇需要的服務", 4, ["新生", "連線教學", "網路報修", "宿網會"]
+    ),
+    "utils.ConfirmWindow": lambda: utils.ConfirmWindow("是否已完成設定？", "已完成", "我需要協助"),
+    "utils.ImageWindow": lambda: utils.ImageWindow(f"{HOST}/static/img/example.jpg"),
+}
+TIME_FIELDS = ("build_us", "sdk_us", "raw_us")
+# 時間小於這個數字 (us) 的差異視為誤差
+TIME_FLOOR_US = 2.0
+ROUNDS = 25
+
+
+def best_us(func, repeat):
+    """ROUNDS 輪中最快一輪的平均每次時間 (us)，每輪執行 repeat 次"""
+    return min(timeit.Timer(func).repeat(ROUNDS, repeat)) / repeat * 1e6
+
+
+def peak_bytes(func):
+    tracemalloc.start()
+    try:
+        func()
+        tracemalloc.clear_traces()
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def intent_case(graph, text):
+    """回傳 (build, handle)，build 不經過快取建立回覆並回傳 payload"""
+    handler = graph.registry.resolve(text)
+    suggestion = None
+    if graph.suggester is not None and graph.registry.match(text) is None:
+        suggestion = graph.suggester.suggest(text)
+
+    def build():
+        if suggestion:
+            messages = graph.suggester._build(tuple(suggestion), HOST).messages
+        else:
+            messages = handler(HOST)
+        return Reply(messages).payload
+
+    event = fastparse.Event("message", "U" + "0" * 32, "bench", 0, text=text)
+
+    def handle():
+        app.handle_message(event, HOST)
+
+    return build, handle
+
+
+def window_case(factory):
+    def build():
+        return json.dumps(factory().as_json_dict(), ensure_ascii=False).encode("utf-8")
+
+    return build, None
+
+
+def cases():
+    """{名稱: (build, handle)}，utils 的視窗沒有 handle"""
+    # 不真的呼叫 LINE API，序列化仍照常進行
+    app.line_bot_api._post = lambda *args, **kwargs: None
+    graph = intents.current()
+    texts = {name: node.texts[0] for name, node in graph.nodes.items()}
+    texts.update(EXTRA_TEXTS)
+    found = {name: intent_case(graph, text) for name, text in texts.items()}
+    found.update((name, window_case(factory)) for name, factory in WINDOWS.items())
+    return found
+
+
+def measure_case(build, handle, repeat):
+    result = {"build_us": best_us(build, repeat)}
+    if handle is not None:
+        for field, raw in (("sdk_us", False), ("raw_us", True)):
+            app.RAW_REPLY = raw
+            handle()
+            result[field] = best_us(handle, repeat)
+        app.RAW_REPLY = False
+    result["alloc"] = peak_bytes(build)
+    result["payload"] = len(build())
+    return result
+
+
+def compare(result, old, threshold, time_threshold):
+    """
+    回傳退步的欄位 {欄位: (baseline, 這次)}
+
+    :params time_threshold: 時間的門檻，None 時不比較時間
+    """
+    regressions = {}
+    for field, value in result.items():
+        if field not in old:
+            continue
+        if field in TIME_FIELDS:
+            if time_threshold is None:
+                continue
+            limit = max(old[field] * (1 + time_threshold), old[field] + TIME_FLOOR_US)
+        else:
+            limit = old[field] * (1 + threshold)
+        if value > limit:
+            regressions[field] = (old[field], value)
+    return regressions
+
+
+def write_baseline(path, results):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                name: {
+                    field: round(value, 1) if isinstance(value, float) else value
+                    for field, value in result.items()
+                }
+                for name, result in results.items()
+            },
+            f,
+            ensure_ascii=False,
+            indent=1,
+            sort_keys=True,
+        )
+        f.write("\n")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="各選項的回覆效能")
+    arg_parser.add_argument("--repeat", type=int, default=40, help="每輪執行次數")
+    arg_parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    arg_parser.add_argument("--update", action="store_true", help="把結果寫成新的 baseline")
+    arg_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="記憶體與 payload 超過 baseline 多少比例算退步，預設 0.25",
+    )
+    arg_parser.add_argument(
+        "--time-threshold", type=float, default=0.5, help="時間的門檻，預設 0.5"
+    )
+    arg_parser.add_argument("--retries", type=int, default=2, help="時間退步時重新量測的次數")
+    arg_parser.add_argument("--no-time", action="store_true", help="不比較時間")
+    args = arg_parser.parse_args()
+
+    all_cases = cases()
+    results = {
+        name: measure_case(build, handle, args.repeat)
+        for name, (build, handle) in all_cases.items()
+    }
+
+    print(
+        f"{'選項':<20} {'build (us)':>10} {'sdk (us)':>9} {'raw (us)':>9} "
+        f"{'alloc (B)':>10} {'payload (B)':>11}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<20} {result['build_us']:>10.1f} {result.get('sdk_us', 0):>9.1f} "
+            f"{result.get('raw_us', 0):>9.1f} {result['alloc']:>10} {result['payload']:>11}"
+        )
+
+    if args.update:
+        # baseline 取多次量測的中位數，避免剛好量到特別快的一次
+        for name, (build, handle) in all_cases.items():
+            runs = [results[name]] + [
+                measure_case(build, handle, args.repeat) for _ in range(args.retries)
+            ]
+            results[name] = {
+                field: statistics.median(run[field] for run in runs)
+                for field in results[name]
+            }
+        write_baseline(args.baseline, results)
+        print(f"已寫入 {args.baseline}")
+        return
+
+    try:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"找不到 {args.baseline}，請先執行 --update")
+        sys.exit(2)
+    missing = sorted(set(baseline) - set(results))
+    if missing:
+        print(f"baseline 有但這次沒有量到：{', '.join(missing)}")
+
+    time_threshold = None if args.no_time else args.time_threshold
+    failed = {}
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        regressions = compare(result, old, args.threshold, time_threshold)
+        for _ in range(args.retries):
+            if not any(field in TIME_FIELDS for field in regressions):
+                break
+            # 可能只是剛好被其他程式搶走 CPU，重新量一次，每個欄位取比較快的
+            retry = measure_case(*all_cases[name], args.repeat)
+            result = {
+                field: min(value, retry[field]) for field, value in result.items()
+            }
+            regressions = compare(result, old, args.threshold, time_threshold)
+        if regressions:
+            failed[name] = regressions
+
+    if failed:
+        print("超過 baseline 門檻的項目：")
+        for name, regressions in failed.items():
+            for field, (old, new) in regressions.items():
+                print(f"  {name} {field}: {old:.1f} -> {new:.1f}")
+        sys.exit(1)
+    print("沒有退步")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+webhook 解析 (fastparse) 的效能測試
+
+    python bench/bench_parse.py [--repeat 2000]
+
+用不同事件數的 body 比較 SDK 的 WebhookParser.parse 與 fastparse.parse，
+兩者都包含驗證簽章；「只驗簽章」一欄是兩者共同的下限。
+SDK 的欄位另外加上去重時為了取 webhookEventId 再解析一次 JSON 的時間，也就是改用 fastparse 之前的做法。
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from linebot import WebhookParser  # noqa: E402
+
+import fastparse  # noqa: E402
+
+CHANNEL_SECRET = "bench-secret"
+TEXTS = ["網路報修", "2-3", "宿網會", "win10", "已完成", "帳號密碼", "你好"]
+
+
+def make_events(count):
+    events = []
+    for i in range(count):
+        event = {
+            "type": "message",
+            "mode": "active",
+            "timestamp": 1700000000000 + i,
+            "source": {"type": "user", "userId": f"U{i:032x}"},
+            "webhookEventId": f"01H{i:023d}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"{i:032x}",
+        }
+        if i % 10 == 9:
+            # 一成是貼圖，不是文字訊息
+            event["message"] = {
+                "type": "sticker",
+                "id": str(i),
+                "packageId": "446",
+                "stickerId": "1988",
+            }
+        else:
+            event["message"] = {
+                "type": "text",
+                "id": str(i),
+                "text": TEXTS[i % len(TEXTS)],
+            }
+        events.append(event)
+    return events
+
+
+def make_body(count):
+    body = json.dumps(
+        {"destination": "U" + "0" * 32, "events": make_events(count)},
+        ensure_ascii=False,
+    ).encode("utf-8")
+    signature = base64.b64encode(
+        hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
+    ).decode("ascii")
+    return body, signature
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--repeat", type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    parser = WebhookParser(CHANNEL_SECRET)
+    print(f"JSON decoder：{fastparse.DECODER}")
+    print(
+        f"{'事件數':>6} {'body (B)':>9} {'只驗簽章 (us)':>14} "
+        f"{'SDK (us)':>10} {'fastparse (us)':>15} {'倍數':>6}"
+    )
+    for count in (1, 5, 20, 100):
+        body, signature = make_body(count)
+        text = body.decode("utf-8")
+        repeat = max(1, args.repeat // count)
+
+        def sdk():
+            parser.parse(text, signature)
+            json.loads(text).get("events", [])
+
+        verify_us = timeit(
+            lambda: fastparse.verify(body, signature, CHANNEL_SECRET), repeat
+        )
+        sdk_us = timeit(sdk, repeat)
+        fast_us = timeit(
+            lambda: fastparse.parse(body, signature, CHANNEL_SECRET), repeat
+        )
+        print(
+            f"{count:>6} {len(body):>9} {verify_us:>14.1f} "
+            f"{sdk_us:>10.1f} {fast_us:>15.1f} {sdk_us / fast_us:>6.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
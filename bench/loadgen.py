@@ -0,0 +1,105 @@
+"""
+產生帶有正確 X-Line-Signature 的 webhook
+
+    python bench/loadgen.py --count 3 [--events 1] [--secret bench-secret]
+
+輸入文字依開學時的實際比例抽樣：查樓層帳號 (含房號) 最多，其次是各作業系統的連線教學與網路報修，
+另外有一部分打錯字或對不到選項的輸入。每個事件的 user_id 與 webhookEventId 都不同，
+不會被去重或單一使用者的限流擋掉；timestamp 為產生當下的時間，reply token 不會被視為過期。
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+DEFAULT_SECRET = "bench-secret"
+
+FLOORS = [
+    f"{dorm}-{floor}"
+    for dorm, floors in ((1, "2345"), (2, "2345678"), (3, "123456"), (4, "123456"))
+    for floor in floors
+]
+# (權重, 文字)
+MIX = [
+    (30, FLOORS),
+    (10, ["二宿三樓", "三宿五樓", "一宿二樓", "四宿一樓"]),
+    (10, ["2301", "1402", "3105", "4611"]),
+    (8, ["查詢網路帳號密碼", "新生", "男生宿舍", "女生宿舍", "二宿"]),
+    (15, ["連線教學", "win10", "Windows 10", "win7", "win8", "mac", "macOS"]),
+    (12, ["網路報修", "已完成", "我需要協助"]),
+    (5, ["宿網會", "意見回饋"]),
+    (10, ["二宿三", "windos", "網路報修啦", "你好", "哈囉", "??"]),
+]
+
+
+class WebhookFactory:
+    """
+    :params secret: channel secret
+    :params seed: 亂數種子，相同的種子產生相同的文字順序
+    """
+
+    def __init__(self, secret=DEFAULT_SECRET, mix=MIX, seed=None):
+        self.secret = secret.encode("utf-8")
+        self._random = random.Random(seed)
+        self._weights = [weight for weight, _ in mix]
+        self._groups = [texts for _, texts in mix]
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._run = f"{os.getpid():x}{time.time_ns():x}"[-12:]
+
+    def text(self):
+        with self._lock:
+            group = self._random.choices(self._groups, self._weights)[0]
+            return self._random.choice(group)
+
+    def event(self, text=None):
+        with self._lock:
+            i = next(self._ids)
+        return {
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": f"U{i:032x}"},
+            "webhookEventId": f"{self._run}{i:014d}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"{self._run}{i:020x}",
+            "message": {"type": "text", "id": str(i), "text": text or self.text()},
+        }
+
+    def sign(self, body):
+        digest = hmac.new(self.secret, body, hashlib.sha256).digest()
+        return base64.b64encode(digest).decode("ascii")
+
+    def webhook(self, events=1):
+        """回傳 (body bytes, X-Line-Signature)"""
+        body = json.dumps(
+            {
+                "destination": "U" + "0" * 32,
+                "events": [self.event() for _ in range(events)],
+            },
+            ensure_ascii=False,
+        ).encode("utf-8")
+        return body, self.sign(body)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="產生簽好名的 webhook")
+    arg_parser.add_argument("--count", type=int, default=1)
+    arg_parser.add_argument("--events", type=int, default=1, help="每個 webhook 的事件數")
+    arg_parser.add_argument("--secret", default=DEFAULT_SECRET)
+    arg_parser.add_argument("--seed", type=int)
+    args = arg_parser.parse_args()
+    factory = WebhookFactory(args.secret, seed=args.seed)
+    for _ in range(args.count):
+        body, signature = factory.webhook(args.events)
+        print(json.dumps({"signature": signature, "body": body.decode("utf-8")}))
+
+
+if __name__ == "__main__":
+    main()
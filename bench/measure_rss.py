@@ -0,0 +1,149 @@
+"""
+量測每個 gunicorn worker 的記憶體
+
+    python bench/measure_rss.py --config sync:4 --config gthread:2x8 [--preload both] [--duration 5]
+
+每個 --config 分別在開啟與關閉 preload (GUNICORN_PRELOAD) 時啟動一次 gunicorn app:app，
+先用 bench/loadgen.py 的 webhook 跑 --duration 秒，讓 worker 碰過每個選項，再讀取 /proc/<pid>/smaps_rollup：
+    RSS：實際佔用的實體記憶體，與其他 process 共用的頁也算在內
+    PSS：共用的頁依共用的 process 數平分，所有 process 的 PSS 加總就是整台機器實際用掉的記憶體
+    shared / private：與其他 process 共用的頁，以及只有自己用的頁
+只能在 Linux 上執行。
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub_line_api  # noqa: E402
+from loadgen import DEFAULT_SECRET, WebhookFactory  # noqa: E402
+from run_load import Driver, parse_config, start_gunicorn, stop_gunicorn  # noqa: E402
+
+FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Shared_Clean": "shared",
+    "Shared_Dirty": "shared",
+    "Private_Clean": "private",
+    "Private_Dirty": "private",
+}
+
+
+def memory(pid):
+    """回傳 {"rss", "pss", "shared", "private"} (KB)"""
+    path = f"/proc/{pid}/smaps_rollup"
+    if not os.path.exists(path):
+        # 4.14 之前的 kernel 沒有 smaps_rollup，自己把每一段加起來
+        path = f"/proc/{pid}/smaps"
+    result = dict.fromkeys(set(FIELDS.values()), 0)
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in FIELDS:
+                result[FIELDS[key]] += int(value.split()[0])
+    return result
+
+
+def children(pid):
+    found = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # comm 可能有空白，從最後一個 ) 之後開始取欄位
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            found.append(int(name))
+    return sorted(found)
+
+
+def wait_for_workers(process, count, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        workers = children(process.pid)
+        if len(workers) >= count:
+            return workers
+        time.sleep(0.2)
+    raise RuntimeError(f"{timeout} 秒內只有 {len(children(process.pid))} 個 worker")
+
+
+def measure(config, preload, args, extra_env):
+    env = dict(extra_env, GUNICORN_PRELOAD="1" if preload else "0")
+    process = start_gunicorn(config, args.port, args.stub_port, env)
+    try:
+        workers = wait_for_workers(process, config[1])
+        if args.duration:
+            factory = WebhookFactory(DEFAULT_SECRET, seed=0)
+            Driver(
+                f"http://127.0.0.1:{args.port}/callback", factory, args.concurrency
+            ).run(args.duration, False)
+        # 背景 thread 與統計寫檔也跑過一輪
+        time.sleep(args.settle)
+        return memory(process.pid), [memory(pid) for pid in workers]
+    finally:
+        stop_gunicorn(process)
+
+
+def mb(kb):
+    return kb / 1024
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="gunicorn worker 的記憶體")
+    arg_parser.add_argument(
+        "--config",
+        action="append",
+        help="worker class:worker 數[x thread 數]，例如 sync:4、gthread:2x8，可以指定多個",
+    )
+    arg_parser.add_argument("--preload", choices=("on", "off", "both"), default="both")
+    arg_parser.add_argument(
+        "--duration", type=float, default=5, help="量測前送出 webhook 的秒數"
+    )
+    arg_parser.add_argument("--concurrency", type=int, default=16)
+    arg_parser.add_argument("--settle", type=float, default=1)
+    arg_parser.add_argument("--port", type=int, default=8090)
+    arg_parser.add_argument("--stub-port", type=int, default=8091)
+    arg_parser.add_argument(
+        "--env", action="append", default=[], help="帶給 gunicorn 的環境變數 KEY=VALUE"
+    )
+    args = arg_parser.parse_args()
+    # 預先建好所有回覆，這部分是 preload 時共用的內容
+    extra_env = {"BOT_HOST": "https://bot.example.com"}
+    extra_env.update(item.split("=", 1) for item in args.env)
+    preloads = {"on": [True], "off": [False], "both": [False, True]}[args.preload]
+
+    server, _ = stub_line_api.serve(args.stub_port, 5, 2)
+    print(
+        f"{'設定':<14} {'preload':>7} {'master RSS':>10} {'worker RSS':>10} "
+        f"{'worker PSS':>10} {'shared':>8} {'private':>8} {'總 PSS':>8}  (MB，worker 取平均)"
+    )
+    try:
+        for spec in args.config or ["sync:4"]:
+            config = parse_config(spec)
+            for preload in preloads:
+                try:
+                    master, workers = measure(config, preload, args, extra_env)
+                except RuntimeError as e:
+                    print(f"{spec:<14} {e}")
+                    continue
+
+                def average(field):
+                    return mb(sum(worker[field] for worker in workers) / len(workers))
+
+                total = master["pss"] + sum(worker["pss"] for worker in workers)
+                print(
+                    f"{spec:<14} {'on' if preload else 'off':>7} {mb(master['rss']):>10.1f} "
+                    f"{average('rss'):>10.1f} {average('pss'):>10.1f} "
+                    f"{average('shared'):>8.1f} {average('private'):>8.1f} {mb(total):>8.1f}"
+                )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
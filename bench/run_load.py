@@ -0,0 +1,268 @@
+"""
+對 /callback 做負載測試
+
+    python bench/run_load.py --config sync:4 --config gthread:2x8 [--concurrency 32] [--duration 10] [--latency 50]
+    python bench/run_load.py --app asgi:app --config uvicorn.workers.UvicornWorker:1
+
+每個 --config (worker class:worker 數[x thread 數]) 各啟動一次 gunicorn app:app (或 --app 指定的入口)，
+LINE API 指向同一個 process 裡的 bench/stub_line_api.py，以 bench/loadgen.py 產生的 webhook 持續送出，
+最後列出每秒處理的請求數、/callback 回應時間的 p50 / p99，以及假 API 實際收到的回覆數。
+ASYNC_REPLY 等其他設定可以用 --env KEY=VALUE 帶給 gunicorn；用 --url 時改測已經在跑的伺服器。
+"""
+import argparse
+import http.client
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub_line_api  # noqa: E402
+from loadgen import DEFAULT_SECRET, WebhookFactory  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_config(spec):
+    """sync:4 -> ("sync", 4, 1)，gthread:2x8 -> ("gthread", 2, 8)"""
+    worker_class, _, size = spec.partition(":")
+    workers, _, threads = (size or "1").partition("x")
+    return worker_class, int(workers), int(threads or 1)
+
+
+def start_gunicorn(config, port, stub_port, extra_env, app="app:app"):
+    worker_class, workers, threads = config
+    state = tempfile.mkdtemp(prefix="dromnet-load-")
+    env = dict(
+        os.environ,
+        CHANNEL_SECRET=DEFAULT_SECRET,
+        CHANNEL_ACCESS_TOKEN="bench",
+        LINE_API_ENDPOINT=f"http://127.0.0.1:{stub_port}",
+        # 測的是處理能力，全體限流會讓結果變成限流的上限
+        GLOBAL_RATE="0",
+        METRICS_DIR=os.path.join(state, "metrics"),
+        FOLLOWERS_PATH=os.path.join(state, "followers.sqlite3"),
+        DEDUPE_PATH=os.path.join(state, "dedupe.sqlite3"),
+        SESSION_PATH=os.path.join(state, "session.sqlite3"),
+        RATE_LIMIT_PATH=os.path.join(state, "ratelimit.sqlite3"),
+    )
+    env.update(extra_env)
+    command = [
+        sys.executable,
+        # gunicorn 20.0 沒有 __main__，不能用 python -m gunicorn
+        "-c",
+        "from gunicorn.app.wsgiapp import run; run()",
+        app,
+        "--config",
+        os.path.join(ROOT, "gunicorn.conf.py"),
+        "--bind",
+        f"127.0.0.1:{port}",
+        "--worker-class",
+        worker_class,
+        "--workers",
+        str(workers),
+        "--threads",
+        str(threads),
+        "--log-level",
+        "warning",
+    ]
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn 啟動失敗 (exit {process.returncode})")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    stop_gunicorn(process)
+    raise RuntimeError("gunicorn 30 秒內沒有啟動")
+
+
+def stop_gunicorn(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+class Driver:
+    """
+    以 concurrency 個 thread 同時對 url 送 webhook，每個 thread 盡量重複使用同一條連線
+
+    :params url: /callback 的完整網址
+    :params events: 每個 webhook 的事件數
+    """
+
+    def __init__(self, url, factory, concurrency=16, events=1):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or "/callback"
+        self.factory = factory
+        self.concurrency = concurrency
+        self.events = events
+        self.latencies = []
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def _worker(self, deadline, record):
+        connection = None
+        latencies = []
+        statuses = {}
+        while time.monotonic() < deadline:
+            body, signature = self.factory.webhook(self.events)
+            if connection is None:
+                connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=30
+                )
+            start = time.perf_counter()
+            try:
+                connection.request(
+                    "POST",
+                    self.path,
+                    body,
+                    {
+                        "Content-Type": "application/json",
+                        "X-Line-Signature": signature,
+                    },
+                )
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+                if response.getheader("Connection", "").lower() == "close":
+                    connection.close()
+                    connection = None
+            except (OSError, http.client.HTTPException):
+                status = "error"
+                connection.close()
+                connection = None
+            if record:
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+        if connection is not None:
+            connection.close()
+        with self._lock:
+            self.latencies.extend(latencies)
+            for status, count in statuses.items():
+                self.statuses[status] = self.statuses.get(status, 0) + count
+
+    def run(self, duration, record=True):
+        deadline = time.monotonic() + duration
+        threads = [
+            threading.Thread(target=self._worker, args=(deadline, record))
+            for _ in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(url, args, stats):
+    factory = WebhookFactory(DEFAULT_SECRET, seed=args.seed)
+    if args.warmup:
+        Driver(url, factory, args.concurrency, args.events).run(args.warmup, False)
+    before = sum(stats.as_dict()["calls"].values())
+    driver = Driver(url, factory, args.concurrency, args.events)
+    driver.run(args.duration)
+    # ASYNC_REPLY=1 時回覆在 200 之後才送出，稍等一下再數
+    time.sleep(args.settle)
+    replies = sum(stats.as_dict()["calls"].values()) - before
+    return {
+        "requests": len(driver.latencies),
+        "rps": len(driver.latencies) / args.duration,
+        "p50": percentile(driver.latencies, 50) * 1000,
+        "p99": percentile(driver.latencies, 99) * 1000,
+        "errors": sum(
+            count for status, count in driver.statuses.items() if status != 200
+        ),
+        "replies": replies,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="/callback 負載測試")
+    arg_parser.add_argument(
+        "--config",
+        action="append",
+        help="worker class:worker 數[x thread 數]，例如 sync:4、gthread:2x8，可以指定多個",
+    )
+    arg_parser.add_argument(
+        "--app", default="app:app", help="gunicorn 載入的入口，例如 asgi:app"
+    )
+    arg_parser.add_argument(
+        "--url", help="測試已經在跑的伺服器，例如 http://127.0.0.1:8000/callback"
+    )
+    arg_parser.add_argument("--concurrency", type=int, default=32)
+    arg_parser.add_argument("--duration", type=float, default=10, help="量測秒數")
+    arg_parser.add_argument("--warmup", type=float, default=2, help="量測前先跑幾秒")
+    arg_parser.add_argument("--settle", type=float, default=1, help="結束後等待背景回覆的秒數")
+    arg_parser.add_argument("--events", type=int, default=1, help="每個 webhook 的事件數")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--port", type=int, default=8090)
+    arg_parser.add_argument("--stub-port", type=int, default=8091)
+    arg_parser.add_argument("--latency", type=float, default=50, help="假 API 的延遲毫秒數")
+    arg_parser.add_argument("--jitter", type=float, default=20)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument(
+        "--env", action="append", default=[], help="帶給 gunicorn 的環境變數 KEY=VALUE"
+    )
+    args = arg_parser.parse_args()
+    extra_env = dict(item.split("=", 1) for item in args.env)
+
+    server, stats = stub_line_api.serve(
+        args.stub_port, args.latency, args.jitter, args.error_rate
+    )
+    print(
+        f"{'設定':<16} {'請求數':>8} {'每秒':>8} {'p50 (ms)':>9} "
+        f"{'p99 (ms)':>9} {'錯誤':>6} {'回覆數':>8}"
+    )
+    if args.url:
+        runs = [(args.url, None)]
+    else:
+        runs = [(spec, parse_config(spec)) for spec in args.config or ["sync:4"]]
+    try:
+        for name, config in runs:
+            process = None
+            url = name
+            try:
+                if config is not None:
+                    process = start_gunicorn(
+                        config, args.port, args.stub_port, extra_env, args.app
+                    )
+                    url = f"http://127.0.0.1:{args.port}/callback"
+                result = measure(url, args, stats)
+            except RuntimeError as e:
+                print(f"{name:<16} {e}")
+                continue
+            finally:
+                if process is not None:
+                    stop_gunicorn(process)
+            print(
+                f"{name:<16} {result['requests']:>8} {result['rps']:>8.1f} "
+                f"{result['p50']:>9.1f} {result['p99']:>9.1f} "
+                f"{result['errors']:>6} {result['replies']:>8}"
+            )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
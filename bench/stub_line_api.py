@@ -0,0 +1,173 @@
+"""
+本機測試用的假 LINE Messaging API
+
+    python bench/stub_line_api.py --port 8081 [--latency 50] [--error-rate 0.1]
+    LINE_API_ENDPOINT=http://127.0.0.1:8081 python announce.py send "測試"
+
+收到 reply / push / multicast 時檢查 request 的格式後回應 200，
+可以加上延遲與隨機的 500 / 429 錯誤；reply token 為 "expired" 時回應 Invalid reply token。
+GET /stats 回傳各 API 的呼叫次數。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LIMITS = {
+    "/v2/bot/message/reply": None,
+    "/v2/bot/message/push": None,
+    "/v2/bot/message/multicast": 500,
+}
+# 用這個 reply token 時回應 400 Invalid reply token
+EXPIRED_REPLY_TOKEN = "expired"
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.recipients = {}
+        self.errors = {}
+        self.retry_keys = set()
+        self.duplicates = 0
+
+    def record(self, path, recipients=0, error=None, retry_key=None):
+        with self._lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+            self.recipients[path] = self.recipients.get(path, 0) + recipients
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+            if retry_key is not None:
+                self.retry_keys.add(retry_key)
+
+    def accepted(self, retry_key):
+        with self._lock:
+            if retry_key in self.retry_keys:
+                self.duplicates += 1
+                return True
+            return False
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "recipients": dict(self.recipients),
+                "errors": dict(self.errors),
+                "duplicates": self.duplicates,
+            }
+
+
+def make_handler(stats, latency, jitter, error_rate, error_status):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body, headers=()):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("X-Line-Request-Id", f"stub-{time.monotonic_ns()}")
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, stats.as_dict())
+            else:
+                self._send(404, {"message": "Not found"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path not in LIMITS:
+                self._send(404, {"message": "Not found"})
+                return
+            if latency or jitter:
+                time.sleep((latency + random.uniform(0, jitter)) / 1000)
+            try:
+                data = json.loads(body)
+                messages = data["messages"]
+                assert 1 <= len(messages) <= 5
+            except (ValueError, KeyError, AssertionError):
+                stats.record(self.path, error=400)
+                self._send(400, {"message": "The request body has 1 error(s)"})
+                return
+
+            to = data.get("to", [])
+            limit = LIMITS[self.path]
+            if limit is not None and not 1 <= len(to) <= limit:
+                stats.record(self.path, error=400)
+                self._send(400, {"message": f"Size must be between 1 and {limit}"})
+                return
+
+            if data.get("replyToken") == EXPIRED_REPLY_TOKEN:
+                stats.record(self.path, error=400)
+                self._send(400, {"message": "Invalid reply token"})
+                return
+
+            retry_key = self.headers.get("X-Line-Retry-Key")
+            if retry_key is not None and stats.accepted(retry_key):
+                self._send(
+                    409,
+                    {"message": "The retry key is already accepted"},
+                    [("X-Line-Accepted-Request-Id", "stub-accepted")],
+                )
+                return
+            if random.random() < error_rate:
+                stats.record(self.path, error=error_status)
+                headers = [("Retry-After", "1")] if error_status == 429 else []
+                self._send(error_status, {"message": "stub error"}, headers)
+                return
+
+            recipients = len(to) if isinstance(to, list) else 1
+            stats.record(self.path, recipients, retry_key=retry_key)
+            self._send(200, {})
+
+    return Handler
+
+
+class StubServer(ThreadingHTTPServer):
+    # 預設的 listen backlog 只有 5，ASGI 模式一次開上百條連線時會被 reset
+    request_queue_size = 1024
+
+
+def serve(port=8081, latency=0, jitter=0, error_rate=0.0, error_status=500):
+    """啟動假 API，回傳 (server, stats)；server 在背景 thread 執行"""
+    stats = Stats()
+    server = StubServer(
+        ("127.0.0.1", port),
+        make_handler(stats, latency, jitter, error_rate, error_status),
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="假的 LINE Messaging API")
+    arg_parser.add_argument("--port", type=int, default=8081)
+    arg_parser.add_argument("--latency", type=float, default=0, help="延遲毫秒數")
+    arg_parser.add_argument("--jitter", type=float, default=0, help="額外的隨機延遲上限 (毫秒)")
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--error-status", type=int, default=500)
+    args = arg_parser.parse_args()
+    server, stats = serve(
+        args.port, args.latency, args.jitter, args.error_rate, args.error_status
+    )
+    print(f"listening on http://127.0.0.1:{args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(stats.as_dict(), indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+可以在執行中更新的內容
+
+ContentStore 定期檢查檔案有沒有變動，有變動就在背景 thread 重新編譯，
+成功後才換上新版本；編譯失敗時記錄錯誤並繼續使用原本的內容。
+處理中的請求拿到的是開始時的版本，換版不會影響它們。
+"""
+import logging
+import os
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+
+class ContentStore:
+    """
+    :params path: 內容檔案
+    :params loader: loader(path) 回傳編譯好的內容，有問題時丟出例外
+    :params interval: 檢查檔案變動的秒數，0 表示不檢查
+    :params on_load: 新內容換上之前先執行 on_load(content)，例如預先建好回覆
+    """
+
+    def __init__(self, path, loader, interval=5.0, on_load=None):
+        self.path = path
+        self.loader = loader
+        self.interval = interval
+        self.on_load = on_load
+        self._current = None
+        self._stamp = None
+        self._failed_stamp = None
+        self._reload_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pid = None
+        self.version = 0
+        self.failures = 0
+        self.last_error = None
+        if hasattr(os, "register_at_fork"):
+            # fork 之前如果已經啟動檢查的 thread，fork 當下鎖可能正被它拿著
+            ref = weakref.ref(self)
+            os.register_at_fork(
+                after_in_child=lambda: ref() is not None and ref()._after_fork()
+            )
+        # 第一次載入失敗就直接讓程式啟動失敗
+        self.reload(force=True)
+
+    @property
+    def current(self):
+        """目前的內容，請在一個請求中只取一次，之後都用同一份。"""
+        self._ensure_started()
+        return self._current
+
+    @property
+    def loaded(self):
+        """
+        目前的內容，但不啟動檢查檔案的 thread，給 import 時用
+        (gunicorn preload 時 import 在 master 裡，thread 應該在 worker 裡才啟動)
+        """
+        return self._current
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def reload(self, force=False):
+        """檔案有變動 (或 force) 時重新載入，有換上新版本時回傳 True。"""
+        with self._reload_lock:
+            stamp = self._stat()
+            if not force and stamp in (self._stamp, self._failed_stamp):
+                return False
+            try:
+                content = self.loader(self.path)
+                if self.on_load is not None:
+                    self.on_load(content)
+            except Exception as e:
+                # 同一個版本的檔案只回報一次，修正後會再試
+                self._failed_stamp = stamp
+                self.failures += 1
+                self.last_error = e
+                raise
+            self._current = content
+            self._stamp = stamp
+            self._failed_stamp = None
+            self.last_error = None
+            self.version += 1
+        logger.info("已載入 %s (第 %d 版)", self.path, self.version)
+        return True
+
+    def check(self):
+        """給背景 thread 用的 reload，失敗時只記錄下來。"""
+        try:
+            return self.reload()
+        except Exception:
+            logger.exception("重新載入 %s 失敗，繼續使用原本的內容", self.path)
+            return False
+
+    def _after_fork(self):
+        self._reload_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pid = None
+
+    def _ensure_started(self):
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(
+                target=self._run, name="content-watch", daemon=True
+            ).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self._stop.set()
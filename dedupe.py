@@ -0,0 +1,146 @@
+"""
+重送 webhook 的去重
+
+回覆太慢時 LINE 會重送同一個 webhook，同一個事件的 webhookEventId 不變。
+處理前先查一下這個 ID 最近是否處理過，處理過就直接略過，不再用掉一次回覆。
+
+SDK 1.19 的 Event 沒有 webhookEventId / deliveryContext，這裡用的是 fastparse.Event。
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+MEMORY = "memory"
+SQLITE = "sqlite"
+BACKENDS = (MEMORY, SQLITE)
+
+
+class _Counter:
+    def __init__(self):
+        self.checks = 0
+        self.hits = 0
+        self.redeliveries = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.checks if self.checks else 0.0
+
+
+class MemoryDedupe(_Counter):
+    """
+    只在同一個 process 內有效的去重
+
+    :params ttl: 記住一個 ID 的秒數
+    :params maxsize: 最多記住幾個 ID，超過時淘汰最舊的
+    """
+
+    def __init__(self, ttl=3600, maxsize=10000):
+        super().__init__()
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        """key 在 ttl 內出現過時回傳 True，否則記下來並回傳 False。"""
+        now = time.monotonic()
+        with self._lock:
+            self.checks += 1
+            expires = self._seen.get(key)
+            if expires is not None and expires > now:
+                self.hits += 1
+                return True
+            self._seen[key] = now + self.ttl
+            self._seen.move_to_end(key)
+            # 依加入順序排列，最前面的最早過期
+            while self._seen and (
+                len(self._seen) > self.maxsize or next(iter(self._seen.values())) <= now
+            ):
+                self._seen.popitem(last=False)
+            return False
+
+    def forget(self, key):
+        """忘記 key，之後重送的同一個事件會再處理一次。"""
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class SQLiteDedupe(_Counter):
+    """
+    存在 SQLite 檔案裡，同一台機器上的所有 gunicorn worker 共用
+
+    :params path: 資料庫檔案
+    :params ttl: 記住一個 ID 的秒數
+    :params purge_every: 每寫入幾次清一次過期的紀錄
+    """
+
+    def __init__(self, path, ttl=3600, purge_every=500):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._connect = storage.LocalConnection(path).get
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires REAL)"
+            )
+
+    def seen(self, key):
+        now = time.time()
+        conn = self._connect()
+        # 沒出現過或已過期時寫入 (rowcount 1)，還沒過期時不動 (rowcount 0)
+        cursor = conn.execute(
+            "INSERT INTO seen (key, expires) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET expires = excluded.expires "
+            "WHERE seen.expires <= ?",
+            (key, now + self.ttl, now),
+        )
+        duplicate = cursor.rowcount == 0
+        self.checks += 1
+        if duplicate:
+            self.hits += 1
+            return True
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            conn.execute("DELETE FROM seen WHERE expires <= ?", (now,))
+        return False
+
+    def forget(self, key):
+        self._connect().execute("DELETE FROM seen WHERE key = ?", (key,))
+
+
+def create(backend=MEMORY, path=None, ttl=3600, maxsize=10000):
+    if backend == MEMORY:
+        return MemoryDedupe(ttl, maxsize)
+    if backend == SQLITE:
+        return SQLiteDedupe(path, ttl)
+    raise ValueError(f"未知的 backend：{backend!r}，可用的有 {BACKENDS}")
+
+
+def unique_events(store, events):
+    """去掉最近處理過的事件 (fastparse.Event)，沒有 webhookEventId 的事件一律保留"""
+    unique = []
+    for event in events:
+        if event.redelivery:
+            store.redeliveries += 1
+        if event.event_id is not None and store.seen(event.event_id):
+            logger.info("略過重複的事件 %s (重複率 %.1f%%)", event.event_id, store.hit_rate * 100)
+            continue
+        unique.append(event)
+    return unique
+
+
+def forget_events(store, events):
+    """事件最後沒有被處理 (例如佇列滿了回應 503) 時呼叫，讓 LINE 重送的事件可以再處理"""
+    for event in events:
+        if event.event_id is not None:
+            store.forget(event.event_id)
@@ -0,0 +1,155 @@
+import json
+import threading
+from collections import OrderedDict
+
+
+class DuplicateIntentError(ValueError):
+    pass
+
+
+class Reply:
+    """
+    某個 host 下已經建立好的回覆
+
+    payload 是 messages 序列化後的 JSON array (bytes)，第一次用到時才產生，
+    之後直接拿來組 reply API 的 request body，不用再走 SDK 的 as_json_dict。
+    """
+
+    __slots__ = ("messages", "_payload")
+
+    def __init__(self, messages):
+        self.messages = tuple(messages)
+        self._payload = None
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = json.dumps(
+                [message.as_json_dict() for message in self.messages],
+                ensure_ascii=False,
+                separators=(",", ":"),
+            ).encode("utf-8")
+        return self._payload
+
+
+class IntentRegistry:
+    """
+    將使用者輸入的文字對應到產生回覆訊息的函式
+
+    以 dict 查詢，不論註冊多少個選項，解析的成本都是固定的。
+    每個 handler 接收 host，回傳要回覆的訊息 list。
+    回覆內容只跟 host 有關，所以每個 host 只會建立一次，
+    之後的請求直接重複使用同一份訊息物件（請勿修改回傳值）。
+
+    :params normalize: 比對前套用在輸入文字與註冊 key 上的函式
+    :params max_hosts: 最多快取幾個 host 的回覆，超過時淘汰最久沒用到的
+    """
+
+    def __init__(self, normalize=None, max_hosts=8):
+        self._normalize = normalize or str.strip
+        self._handlers = {}
+        self._fallback = None
+        self._matchers = []
+        self._max_hosts = max_hosts
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, *texts):
+        def decorator(func):
+            for text in texts:
+                key = self._normalize(text)
+                if key in self._handlers:
+                    raise DuplicateIntentError(f"重複註冊的選項：{text!r}")
+                self._handlers[key] = func
+            self.clear_cache()
+            return func
+
+        return decorator
+
+    def fallback(self, func):
+        if self._fallback is not None:
+            raise DuplicateIntentError("fallback 只能註冊一次")
+        self._fallback = func
+        self.clear_cache()
+        return func
+
+    def add_matcher(self, matcher, handlers=()):
+        """
+        dict 查不到時依序呼叫 matcher(正規化後的文字)，回傳 handler 或 None
+
+        :params handlers: matcher 可能回傳的所有 handler，warm 時一起建立
+        """
+        self._matchers.append((matcher, tuple(handlers)))
+        self.clear_cache()
+
+    def match(self, text):
+        """回傳 text 對應的 handler，找不到時回傳 None。"""
+        key = self._normalize(text or "")
+        handler = self._handlers.get(key)
+        if handler is not None:
+            return handler
+        for matcher, _ in self._matchers:
+            handler = matcher(key)
+            if handler is not None:
+                return handler
+        return None
+
+    def resolve(self, text):
+        """回傳 text 對應的 handler，找不到時回傳 fallback。"""
+        return self.match(text) or self._fallback
+
+    def dispatch(self, text, host=""):
+        return self.reply_for(text, host).messages
+
+    def reply_for(self, text, host=""):
+        handler = self.resolve(text)
+        if handler is None:
+            return Reply(())
+        return self.replies(handler, host)
+
+    def replies(self, handler, host=""):
+        """回傳 handler 在 host 下的 Reply，第一次用到時才建立。"""
+        with self._lock:
+            built = self._cache.get(host)
+            if built is None:
+                built = self._cache[host] = {}
+                if len(self._cache) > self._max_hosts:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(host)
+            reply = built.get(handler)
+        if reply is not None:
+            self.hits += 1
+            return reply
+
+        self.misses += 1
+        # 在鎖外建立，同時間第一次進來的請求最多只會多建一次
+        reply = built[handler] = Reply(handler(host))
+        return reply
+
+    def warm(self, host, serialize=False):
+        """預先建立 host 下所有選項的回覆，serialize 時連 payload 一起產生。"""
+        handlers = set(self._handlers.values())
+        if self._fallback is not None:
+            handlers.add(self._fallback)
+        for _, extra in self._matchers:
+            handlers.update(extra)
+        for handler in handlers:
+            reply = self.replies(handler, host)
+            if serialize:
+                reply.payload
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def intents(self):
+        return list(self._handlers)
+
+    def __contains__(self, text):
+        return self._normalize(text or "") in self._handlers
+
+    def __len__(self):
+        return len(self._handlers)
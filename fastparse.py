@@ -0,0 +1,142 @@
+"""
+精簡的 webhook 解析
+
+SDK 的 WebhookParser 會把整個 body 轉成 Event / Source / Message 物件，
+但回覆文字訊息只需要 type、文字、reply token 與 user_id。
+這裡驗證簽章後直接從 JSON 取出這幾個欄位；文字訊息以外的事件只用來記錄追蹤者，不轉成任何物件。
+有安裝 orjson 或 ujson 時用它們解析 JSON。
+"""
+import base64
+import hashlib
+import hmac
+import json
+
+from linebot.exceptions import InvalidSignatureError
+
+try:
+    import orjson
+
+    loads = orjson.loads
+    DECODER = "orjson"
+except ImportError:
+    try:
+        import ujson
+
+        loads = ujson.loads
+        DECODER = "ujson"
+    except ImportError:
+        loads = json.loads
+        DECODER = "json"
+
+# 與 WebhookParser.parse 支援的事件相同
+EVENT_TYPES = frozenset(
+    (
+        "message",
+        "follow",
+        "unfollow",
+        "join",
+        "leave",
+        "postback",
+        "beacon",
+        "accountLink",
+        "memberJoined",
+        "memberLeft",
+        "things",
+        "unsend",
+        "videoPlayComplete",
+    )
+)
+
+
+class Event:
+    """
+    webhook 事件裡會用到的欄位
+
+    文字訊息時 text 為訊息內容，其他事件為 None。
+
+    :params type: 事件的 type，例如 message、follow
+    :params user_id: source.userId，沒有時為 None
+    :params event_id: webhookEventId
+    :params redelivery: deliveryContext.isRedelivery
+    """
+
+    __slots__ = (
+        "type",
+        "user_id",
+        "reply_token",
+        "timestamp",
+        "event_id",
+        "redelivery",
+        "text",
+    )
+
+    def __init__(
+        self,
+        type,
+        user_id=None,
+        reply_token=None,
+        timestamp=0,
+        event_id=None,
+        redelivery=False,
+        text=None,
+    ):
+        self.type = type
+        self.user_id = user_id
+        self.reply_token = reply_token
+        self.timestamp = timestamp
+        self.event_id = event_id
+        self.redelivery = redelivery
+        self.text = text
+
+    @classmethod
+    def from_json(cls, raw):
+        message = raw.get("message")
+        text = None
+        if message is not None and message.get("type") == "text":
+            text = message.get("text")
+        return cls(
+            raw.get("type"),
+            raw.get("source", {}).get("userId"),
+            raw.get("replyToken"),
+            raw.get("timestamp", 0),
+            raw.get("webhookEventId"),
+            raw.get("deliveryContext", {}).get("isRedelivery", False),
+            text,
+        )
+
+    def __repr__(self):
+        return (
+            f"Event(type={self.type!r}, user_id={self.user_id!r}, text={self.text!r})"
+        )
+
+
+def verify(body, signature, channel_secret):
+    """
+    :params body: request body (bytes)
+    :params signature: X-Line-Signature
+    """
+    digest = hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return hmac.compare_digest(
+        base64.b64encode(digest), (signature or "").encode("utf-8")
+    )
+
+
+def events(body):
+    """不驗證簽章直接解析 body，回傳 Event list"""
+    # 和 WebhookParser 一樣略過不認得的事件 type
+    return [
+        Event.from_json(raw)
+        for raw in loads(body).get("events", ())
+        if raw.get("type") in EVENT_TYPES
+    ]
+
+
+def parse(body, signature, channel_secret):
+    """
+    驗證簽章並回傳 Event list，簽章不符時丟出 InvalidSignatureError
+
+    :params body: request body (bytes)
+    """
+    if not verify(body, signature, channel_secret):
+        raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+    return events(body)
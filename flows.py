@@ -0,0 +1,634 @@
+"""
+對話流程的編譯器
+
+content/flows.json 描述機器人所有的選項與回覆，啟動時編譯成不可修改的 FlowGraph：
+每個節點記錄觸發它的文字、要回覆的訊息與訊息上的按鈕 (通往下一個節點)。
+編譯時會檢查 LINE 訊息格式的限制，有任何問題就丟出 FlowError 並列出所有問題。
+
+資料格式：
+    alt_text: 樣板訊息的替代文字
+    snippets: 可重複使用的訊息，在 messages 中以 {"use": 名稱} 引用
+    templates: 帶參數的訊息組，節點以 {"template": 名稱, "params": {...}} 使用，
+        字串中的 {參數名稱} 會被換成參數值
+    nodes: 以觸發文字為 key 的節點，aliases 為其他也會觸發的文字，
+        contexts 依使用者的上一個節點換成不同的回覆 ({上一個節點: {"messages": [...]}})
+    fallback: 找不到對應節點時的回覆，aliases 為明確回到這裡的文字
+    suggestions: 找不到選項時，以 quick reply 列出最相似的 k 個節點 (相似度至少 min_score)，
+        後面接著 fallback 的 quick reply
+    throttled: 訊息太多被限流時回覆的內容
+    rooms: 房號索引，使用 template 的節點以 param 參數 (例如 "2-3") 對應到宿舍與樓層，
+        error 是沒有這個宿舍或樓層時的回覆
+
+訊息 type：text (可加 quick_reply)、image、buttons、confirm、carousel
+"""
+import functools
+import json
+import logging
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from linebot.models import (
+    TextSendMessage,
+    TemplateSendMessage,
+    MessageAction,
+    QuickReply,
+    QuickReplyButton,
+)
+from linebot.models.actions import URIAction
+from linebot.models.template import CarouselColumn, CarouselTemplate
+
+from assets import IMG_DIR, URL_PREFIX, variant_url
+from dispatch import DuplicateIntentError, IntentRegistry, Reply
+from fuzzy import NgramIndex
+from normalize import normalize
+from rooms import RoomIndex
+import utils
+
+logger = logging.getLogger(__name__)
+
+# LINE Messaging API 的限制
+MAX_MESSAGES = 5
+MAX_ALT_TEXT = 400
+MAX_TEXT = 5000
+MAX_QUICK_REPLY = 13
+MAX_LABEL = 20
+# message action 送出的文字
+MAX_ACTION_TEXT = 300
+MAX_TITLE = 40
+MAX_BUTTONS_ACTIONS = 4
+MAX_BUTTONS_TEXT_WITH_TITLE = 60
+MAX_CONFIRM_TEXT = 240
+MAX_COLUMNS = 10
+MAX_COLUMN_TEXT_WITH_TITLE = 60
+
+DEFAULT_LINK_LABEL = "點我，觀看完整圖片"
+
+Node = namedtuple("Node", ["name", "texts", "messages", "buttons"])
+# key：正規化後的文字，node：對應的 Node (找不到時為 fallback)，matched：是否對應到選項
+Match = namedtuple("Match", ["key", "node", "matched"])
+
+
+class FlowError(ValueError):
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__("對話流程有 %d 個問題：\n%s" % (len(problems), "\n".join(problems)))
+
+
+class FlowGraph:
+    """
+    編譯好的對話流程
+
+    :params nodes: 節點名稱對應 Node
+    :params fallback: 找不到對應節點時使用的 Node
+    :params registry: 觸發文字對應到建立訊息的 IntentRegistry
+    :params stats: 編譯耗時 (compile_ms) 與內容大小 (footprint_bytes) 等資訊
+    :params warnings: 不影響運作的問題，例如按鈕沒有對應的節點
+    :params rooms: 房號對應到 Node 的 RoomIndex，沒有設定時為 None
+    :params suggester: 找不到選項時建議相似選項的 Suggester，沒有設定時為 None
+    :params variants: (節點名稱, 上一個節點名稱) 對應到 (Node, handler)
+    :params throttled: 被限流時回覆的 (Node, handler)，沒有設定時為 None
+    :params handlers: 節點名稱 (fallback 為 None) 對應到建立訊息的 handler
+    """
+
+    def __init__(
+        self,
+        nodes,
+        fallback,
+        registry,
+        stats,
+        warnings,
+        rooms=None,
+        suggester=None,
+        variants=None,
+        throttled=None,
+        handlers=None,
+    ):
+        self.nodes = MappingProxyType(nodes)
+        # 正規化後的觸發文字 -> Node
+        self.index = MappingProxyType(
+            {normalize(text): node for node in nodes.values() for text in node.texts}
+        )
+        self.fallback = fallback
+        self.registry = registry
+        self.stats = MappingProxyType(stats)
+        self.warnings = tuple(warnings)
+        self.rooms = rooms
+        self.suggester = suggester
+        self.variants = MappingProxyType(variants or {})
+        self.throttled = throttled
+        self.handlers = MappingProxyType(handlers or {})
+        # 明確指向 fallback 的文字 (例如「回到一開始」) 不算找不到選項
+        self._fallback_keys = frozenset(
+            normalize(text) for text in (fallback.texts if fallback else ())
+        )
+
+    def match(self, text):
+        """只正規化一次，回傳 Match，之後交給 reply_for 使用"""
+        key = normalize(text or "")
+        node = self.index.get(key)
+        if node is None and self.rooms is not None:
+            node = self.rooms.lookup(key)
+        if node is not None:
+            return Match(key, node, True)
+        return Match(key, self.fallback, key in self._fallback_keys)
+
+    def node_for(self, text):
+        """回傳 text 對應的 Node，找不到時回傳 fallback。"""
+        return self.match(text).node
+
+    def reply_for(self, text, host="", previous=None, match=None):
+        """
+        :params previous: 使用者的上一個節點名稱，節點有對應的 contexts 時改用該版本
+        :params match: 已經算好的 self.match(text)
+        """
+        key, node, matched = match or self.match(text)
+        if node is None:
+            return Reply(())
+        if previous is not None and self.variants:
+            variant = self.variants.get((node.name, previous))
+            if variant is not None:
+                return self.registry.replies(variant[1], host)
+        if not matched and self.suggester is not None:
+            reply = self.suggester.reply_for(key, host)
+            if reply is not None:
+                return reply
+        return self.registry.replies(self.handlers[node.name], host)
+
+    def dispatch(self, text, host="", previous=None):
+        return self.reply_for(text, host, previous).messages
+
+    def throttled_reply(self, host=""):
+        """被限流時的回覆，沒有設定時回傳 None"""
+        if self.throttled is None:
+            return None
+        return self.registry.replies(self.throttled[1], host)
+
+    def warm(self, host, serialize=False):
+        """預先建立 host 下所有回覆，包含 contexts 的版本"""
+        self.registry.warm(host, serialize)
+        extra = list(self.variants.values())
+        if self.throttled is not None:
+            extra.append(self.throttled)
+        for _, handler in extra:
+            reply = self.registry.replies(handler, host)
+            if serialize:
+                reply.payload
+
+
+class Suggester:
+    """
+    找不到選項時回覆最相似的幾個選項
+
+    相同的建議組合在同一個 host 下只建立一次訊息，最多保留 cache_size 組。
+
+    :params index: 正規化後的文字對應到節點名稱的 NgramIndex
+    :params spec: flows.json 的 suggestions
+    :params menu: 接在建議後面的 quick reply 項目 (fallback 的選單)
+    """
+
+    def __init__(self, index, spec, menu=(), alt_text="", cache_size=256):
+        self.index = index
+        self.text = spec["text"]
+        self.k = spec.get("k", 4)
+        self.min_score = spec.get("min_score", 0.3)
+        self.menu = tuple(menu)
+        self.alt_text = alt_text
+        self._reply = functools.lru_cache(cache_size)(self._build)
+
+    def suggest(self, text):
+        return self.index.search(normalize(text), self.k, self.min_score)
+
+    def reply_for(self, key, host=""):
+        """
+        :params key: 正規化後的文字
+        """
+        names = self.index.search(key, self.k, self.min_score)
+        if not names:
+            return None
+        return self._reply(tuple(names), host)
+
+    def cache_info(self):
+        return self._reply.cache_info()
+
+    def _build(self, names, host):
+        items = [{"label": name[:MAX_LABEL], "text": name} for name in names]
+        items += [item for item in self.menu if item["text"] not in names]
+        message = {
+            "type": "text",
+            "text": self.text,
+            "quick_reply": items[:MAX_QUICK_REPLY],
+        }
+        return Reply(build_messages([message], self.alt_text, host))
+
+
+# =========== 編譯 ===========
+
+
+def load(path, **kwargs):
+    with open(path, encoding="utf-8") as f:
+        return compile_flows(json.load(f), **kwargs)
+
+
+def compile_flows(data, host=None):
+    """
+    把 flows.json 的內容編譯成 FlowGraph
+
+    :params data: flows.json 解析後的 dict
+    :params host: 有給的話順便建好這個 host 的所有回覆
+    """
+    start = time.perf_counter()
+    problems = []
+    alt_text = data.get("alt_text", "")
+    if not alt_text or len(alt_text) > MAX_ALT_TEXT:
+        problems.append(f"alt_text 必須是 1 到 {MAX_ALT_TEXT} 個字")
+    snippets = data.get("snippets", {})
+    templates = data.get("templates", {})
+
+    nodes = {}
+    for name, spec in data.get("nodes", {}).items():
+        where = f"nodes.{name}"
+        messages = _expand(spec, snippets, templates, where, problems)
+        _check_messages(messages, where, problems)
+        texts = (name,) + tuple(spec.get("aliases", ()))
+        nodes[name] = Node(name, texts, _freeze(messages), _buttons(messages))
+
+    variants = {}
+    for name, spec in data.get("nodes", {}).items():
+        for previous, context in spec.get("contexts", {}).items():
+            where = f"nodes.{name}.contexts.{previous}"
+            if previous not in nodes:
+                problems.append(f"{where}: 沒有「{previous}」這個節點")
+            messages = _expand(context, snippets, templates, where, problems)
+            _check_messages(messages, where, problems)
+            node = Node(name, (), _freeze(messages), _buttons(messages))
+            variants[(name, previous)] = (node, _handler(node, alt_text))
+
+    fallback = None
+    if "fallback" in data:
+        messages = _expand(data["fallback"], snippets, templates, "fallback", problems)
+        _check_messages(messages, "fallback", problems)
+        texts = tuple(data["fallback"].get("aliases", ()))
+        fallback = Node(None, texts, _freeze(messages), _buttons(messages))
+
+    throttled = None
+    if "throttled" in data:
+        messages = _expand(
+            data["throttled"], snippets, templates, "throttled", problems
+        )
+        _check_messages(messages, "throttled", problems)
+        node = Node("throttled", (), _freeze(messages), _buttons(messages))
+        throttled = (node, _handler(node, alt_text))
+
+    rooms = None
+    if "rooms" in data:
+        rooms = _compile_rooms(data, nodes, snippets, templates, problems)
+
+    registry = IntentRegistry(normalize=normalize)
+    handlers = {}
+    for node in nodes.values():
+        handlers[node.name] = _handler(node, alt_text)
+        try:
+            registry.register(*node.texts)(handlers[node.name])
+        except DuplicateIntentError as e:
+            problems.append(f"nodes.{node.name}: {e}")
+    if rooms is not None:
+        handlers[rooms.error.name] = _handler(rooms.error, alt_text)
+        room_handlers = RoomIndex(
+            {floor: handlers[node.name] for floor, node in rooms.floors.items()},
+            handlers[rooms.error.name],
+        )
+        registry.add_matcher(room_handlers.lookup, room_handlers.values())
+    if fallback is not None:
+        handler = handlers[None] = _handler(fallback, alt_text)
+        registry.fallback(handler)
+        if fallback.texts:
+            # 明確指向 fallback 的文字，例如「回到一開始」
+            try:
+                registry.register(*fallback.texts)(handler)
+            except DuplicateIntentError as e:
+                problems.append(f"fallback: {e}")
+
+    suggestions = data.get("suggestions")
+    if suggestions is not None:
+        _check_length(
+            problems, "suggestions", "text", suggestions.get("text"), MAX_TEXT
+        )
+        if not 1 <= suggestions.get("k", 4) < MAX_QUICK_REPLY:
+            problems.append(f"suggestions: k 必須是 1 到 {MAX_QUICK_REPLY - 1}")
+
+    if problems:
+        raise FlowError(problems)
+
+    suggester = None
+    if suggestions is not None:
+        menu = [
+            item
+            for message in (fallback.messages if fallback else ())
+            for item in message.get("quick_reply", ())
+        ]
+        index = NgramIndex(
+            (normalize(text), node.name)
+            for node in nodes.values()
+            for text in node.texts
+        )
+        suggester = Suggester(index, suggestions, menu, alt_text)
+
+    warnings = [
+        f"{node.name or 'fallback'}: 按鈕「{label}」沒有對應的節點，會回覆 fallback"
+        for node in list(nodes.values())
+        + [node for node, _ in variants.values()]
+        + [fallback, rooms and rooms.error]
+        if node
+        for label in node.buttons
+        if label not in registry
+    ]
+    stats = {
+        "nodes": len(nodes),
+        "intents": len(registry),
+        "compile_ms": round((time.perf_counter() - start) * 1000, 3),
+        "rooms": len(rooms.floors) if rooms is not None else 0,
+        "variants": len(variants),
+        "footprint_bytes": _deep_size(
+            (nodes, fallback, rooms and rooms.error, [n for n, _ in variants.values()])
+        ),
+    }
+    graph = FlowGraph(
+        nodes,
+        fallback,
+        registry,
+        stats,
+        warnings,
+        rooms,
+        suggester,
+        variants,
+        throttled,
+        handlers,
+    )
+    if host is not None:
+        registry.warm(host)
+    logger.info(
+        "對話流程編譯完成：%(nodes)d 個節點、%(intents)d 個選項，"
+        "耗時 %(compile_ms).1f ms，佔用 %(footprint_bytes)d bytes",
+        stats,
+    )
+    for warning in warnings:
+        logger.warning(warning)
+    return graph
+
+
+def _compile_rooms(data, nodes, snippets, templates, problems):
+    spec = data["rooms"]
+    messages = _expand(
+        spec.get("error", {}), snippets, templates, "rooms.error", problems
+    )
+    _check_messages(messages, "rooms.error", problems)
+    error = Node("rooms.error", (), _freeze(messages), _buttons(messages))
+
+    floors = {}
+    for name, node_spec in data.get("nodes", {}).items():
+        if node_spec.get("template") != spec.get("template"):
+            continue
+        value = node_spec.get("params", {}).get(spec.get("param"), "")
+        match = re.fullmatch(r"(\d)-(\d)", value)
+        if match is None:
+            problems.append(f"nodes.{name}: 房號索引需要「宿舍-樓層」格式的參數，目前是 {value!r}")
+            continue
+        floor = match.group(1) + match.group(2)
+        if floor in floors:
+            problems.append(f"nodes.{name}: 與 nodes.{floors[floor].name} 是同一個樓層")
+            continue
+        floors[floor] = nodes[name]
+    if not floors:
+        problems.append(f"rooms: 沒有使用 template「{spec.get('template')}」的節點")
+    return RoomIndex(floors, error)
+
+
+def _substitute(value, params):
+    if isinstance(value, str):
+        for key, param in params.items():
+            value = value.replace("{%s}" % key, str(param))
+        return value
+    if isinstance(value, list):
+        return [_substitute(item, params) for item in value]
+    if isinstance(value, dict):
+        return {key: _substitute(item, params) for key, item in value.items()}
+    return value
+
+
+def _expand(spec, snippets, templates, where, problems):
+    if "template" in spec:
+        template = templates.get(spec["template"])
+        if template is None:
+            problems.append(f"{where}: 找不到 template「{spec['template']}」")
+            return []
+        params = spec.get("params", {})
+        missing = set(template.get("params", ())) - set(params)
+        unknown = set(params) - set(template.get("params", ()))
+        if missing or unknown:
+            problems.append(
+                f"{where}: template 參數不符，缺少 {sorted(missing)}，多出 {sorted(unknown)}"
+            )
+        raw = _substitute(template["messages"], params)
+    else:
+        raw = spec.get("messages", [])
+
+    messages = []
+    for message in raw:
+        if "use" in message:
+            snippet = snippets.get(message["use"])
+            if snippet is None:
+                problems.append(f"{where}: 找不到 snippet「{message['use']}」")
+                continue
+            message = snippet
+        messages.append(message)
+    return messages
+
+
+def _check_length(problems, where, field, value, limit, minimum=1):
+    if not isinstance(value, str) or not minimum <= len(value) <= limit:
+        problems.append(f"{where}: {field} 必須是 {minimum} 到 {limit} 個字，目前是 {value!r}")
+
+
+def _check_labels(problems, where, labels, minimum, maximum):
+    if not isinstance(labels, list) or not minimum <= len(labels) <= maximum:
+        problems.append(f"{where}: 按鈕必須有 {minimum} 到 {maximum} 個")
+        return
+    for label in labels:
+        _check_length(problems, where, "按鈕文字", label, MAX_LABEL)
+
+
+def _check_image(problems, where, field, path):
+    path = str(path or "")
+    if not path.startswith("/"):
+        problems.append(f"{where}: {field} 必須以 / 開頭")
+    elif path.startswith(URL_PREFIX):
+        # 打錯的路徑在這裡擋下來，否則要到送出時才會發現圖片不存在
+        full_path = os.path.normpath(os.path.join(IMG_DIR, path[len(URL_PREFIX) :]))
+        if not full_path.startswith(IMG_DIR + os.sep) or not os.path.isfile(full_path):
+            problems.append(f"{where}: 找不到 {field} 的圖片 {path}")
+
+
+def _check_messages(messages, where, problems):
+    if not 1 <= len(messages) <= MAX_MESSAGES:
+        problems.append(f"{where}: 一次回覆必須有 1 到 {MAX_MESSAGES} 則訊息")
+    for i, message in enumerate(messages):
+        at = f"{where}.messages[{i}]"
+        kind = message.get("type")
+        if kind == "text":
+            _check_length(problems, at, "text", message.get("text"), MAX_TEXT)
+            quick_reply = message.get("quick_reply")
+            if quick_reply is not None:
+                if not 1 <= len(quick_reply) <= MAX_QUICK_REPLY:
+                    problems.append(f"{at}: quick_reply 必須有 1 到 {MAX_QUICK_REPLY} 個")
+                for item in quick_reply:
+                    _check_length(
+                        problems, at, "quick_reply label", item.get("label"), MAX_LABEL
+                    )
+                    _check_length(
+                        problems,
+                        at,
+                        "quick_reply text",
+                        item.get("text"),
+                        MAX_ACTION_TEXT,
+                    )
+        elif kind == "image":
+            _check_image(problems, at, "image 的 path", message.get("path"))
+        elif kind == "buttons":
+            _check_length(problems, at, "title", message.get("title"), MAX_TITLE)
+            _check_length(
+                problems, at, "text", message.get("text"), MAX_BUTTONS_TEXT_WITH_TITLE
+            )
+            _check_labels(problems, at, message.get("actions"), 1, MAX_BUTTONS_ACTIONS)
+        elif kind == "confirm":
+            _check_length(problems, at, "text", message.get("text"), MAX_CONFIRM_TEXT)
+            _check_labels(problems, at, [message.get("yes"), message.get("no")], 2, 2)
+        elif kind == "carousel":
+            columns = message.get("columns", [])
+            if not 1 <= len(columns) <= MAX_COLUMNS:
+                problems.append(f"{at}: carousel 必須有 1 到 {MAX_COLUMNS} 欄")
+            for j, column in enumerate(columns):
+                col_at = f"{at}.columns[{j}]"
+                _check_length(problems, col_at, "title", column.get("title"), MAX_TITLE)
+                _check_length(
+                    problems,
+                    col_at,
+                    "text",
+                    column.get("text"),
+                    MAX_COLUMN_TEXT_WITH_TITLE,
+                )
+                _check_image(problems, col_at, "image", column.get("image"))
+                link = column.get("link", {})
+                _check_length(
+                    problems,
+                    col_at,
+                    "link label",
+                    link.get("label", DEFAULT_LINK_LABEL),
+                    MAX_LABEL,
+                )
+        else:
+            problems.append(f"{at}: 未知的訊息 type {kind!r}")
+
+
+def _buttons(messages):
+    labels = []
+    for message in messages:
+        kind = message.get("type")
+        if kind == "buttons":
+            labels.extend(message.get("actions", ()))
+        elif kind == "confirm":
+            labels.extend((message.get("yes"), message.get("no")))
+        elif kind == "text":
+            labels.extend(item.get("text") for item in message.get("quick_reply", ()))
+    return tuple(dict.fromkeys(labels))
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _deep_size(value, seen=None):
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, MappingProxyType):
+        value = dict(value)
+        size += sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_deep_size(item, seen) for item in value)
+    return size
+
+
+# =========== 建立訊息 ===========
+
+
+def _handler(node, alt_text):
+    return functools.partial(build_messages, node.messages, alt_text)
+
+
+def build_messages(messages, alt_text, host):
+    return [_build(message, alt_text, host) for message in messages]
+
+
+def _build(message, alt_text, host):
+    kind = message["type"]
+    if kind == "text":
+        quick_reply = None
+        if "quick_reply" in message:
+            quick_reply = QuickReply(
+                items=[
+                    QuickReplyButton(
+                        action=MessageAction(label=item["label"], text=item["text"])
+                    )
+                    for item in message["quick_reply"]
+                ]
+            )
+        return TextSendMessage(text=message["text"], quick_reply=quick_reply)
+    if kind == "image":
+        return utils.ImageWindow(origin_path=f"{host}{message['path']}")
+    if kind == "buttons":
+        return utils.ButtonWindow(
+            title=message["title"],
+            context=message["text"],
+            number=len(message["actions"]),
+            label_list=message["actions"],
+        )
+    if kind == "confirm":
+        return utils.ConfirmWindow(
+            context=message["text"],
+            success_string=message["yes"],
+            error_string=message["no"],
+        )
+    return TemplateSendMessage(
+        alt_text=alt_text,
+        template=CarouselTemplate(
+            columns=[_column(column, host) for column in message["columns"]]
+        ),
+    )
+
+
+def _column(column, host):
+    image = f"{host}{column['image']}"
+    link = column.get("link", {})
+    return CarouselColumn(
+        thumbnail_image_url=variant_url(image, "thumb"),
+        title=column["title"],
+        text=column["text"],
+        actions=[
+            URIAction(
+                label=link.get("label", DEFAULT_LINK_LABEL),
+                uri=link.get("uri", variant_url(image)),
+            )
+        ],
+    )
@@ -0,0 +1,71 @@
+"""
+打錯字時的選項建議
+
+把所有選項 (含 aliases) 正規化後切成 n-gram 建立反向索引，
+找不到完全相同的選項時，回傳相似度 (Dice 係數) 最高的幾個。
+輸入只看前 max_length 個字，出現在太多選項裡的 n-gram 也不拿來比對，
+所以查詢的成本有上限，不會隨選項數量一直增加。
+"""
+import heapq
+
+
+class NgramIndex:
+    """
+    :params entries: (正規化後的文字, 目標) 的 iterable，同一個目標可以有多個文字
+    :params n: n-gram 的長度
+    :params max_postings: 一個 n-gram 出現在超過這麼多個文字時忽略它
+    :params max_length: 查詢時只看輸入的前幾個字
+    """
+
+    def __init__(self, entries, n=2, max_postings=64, max_length=32):
+        self.n = n
+        self.max_postings = max_postings
+        self.max_length = max_length
+        self._targets = []
+        self._sizes = []
+        postings = {}
+        for text, target in entries:
+            grams = self.grams(text)
+            if not grams:
+                continue
+            i = len(self._targets)
+            self._targets.append(target)
+            self._sizes.append(len(grams))
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        self._postings = {
+            gram: tuple(ids)
+            for gram, ids in postings.items()
+            if len(ids) <= max_postings
+        }
+        # 同分時依註冊順序排
+        self._order = {}
+        for target in self._targets:
+            self._order.setdefault(target, len(self._order))
+
+    def grams(self, text):
+        if len(text) <= self.n:
+            return {text} if text else set()
+        return {text[i : i + self.n] for i in range(len(text) - self.n + 1)}
+
+    def search(self, text, k=4, min_score=0.3):
+        """回傳最相似的 k 個目標，相似度低於 min_score 的不算"""
+        grams = self.grams(text[: self.max_length])
+        overlaps = {}
+        for gram in grams:
+            for i in self._postings.get(gram, ()):
+                overlaps[i] = overlaps.get(i, 0) + 1
+
+        best = {}
+        for i, overlap in overlaps.items():
+            score = 2 * overlap / (len(grams) + self._sizes[i])
+            target = self._targets[i]
+            if score >= min_score and score > best.get(target, 0):
+                best[target] = score
+        ranked = heapq.nlargest(
+            k, best.items(), key=lambda item: (item[1], -self._order[item[0]])
+        )
+        return [target for target, _ in ranked]
+
+    def __len__(self):
+        return len(self._targets)
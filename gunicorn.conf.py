@@ -1,4 +1,86 @@
+"""
+gunicorn 設定，全部可以用環境變數調整 (說明見 README 的「部署」)
+
+    GUNICORN_WORKER_CLASS=gthread gunicorn app:app
+"""
+import gc
+import math
 import os
 
-workers = 4
-bind = f"{os.environ.get('IP')}:{os.environ.get('PORT')}"
+# =========== worker ===========
+if hasattr(os, "sched_getaffinity"):
+    cpus = len(os.sched_getaffinity(0))
+else:
+    cpus = os.cpu_count() or 1
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+if worker_class == "sync":
+    # 每個 worker 一次只處理一個請求，等 LINE API 時整個 worker 都閒著，所以開多一點
+    default_workers = 2 * cpus + 1
+else:
+    default_workers = cpus + 1
+# Heroku 會依 dyno 的記憶體設定 WEB_CONCURRENCY
+workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
+# gthread：每個 worker 的 thread 數，大部分時間在等網路，可以比 CPU 數多很多
+threads = int(os.environ.get("GUNICORN_THREADS", max(8, 4 * cpus)))
+# gevent：每個 worker 同時處理的連線數
+worker_connections = int(os.environ.get("GUNICORN_CONNECTIONS", 100))
+
+# 連線池大小對上同時送出回覆的數量
+if worker_class == "gthread":
+    os.environ.setdefault("LINE_POOL_SIZE", str(threads))
+elif worker_class == "gevent":
+    os.environ.setdefault("LINE_POOL_SIZE", str(worker_connections))
+
+# =========== preload ===========
+# master 先 import app (含 BOT_HOST 預先建好的回覆)，fork 出的 worker 以 copy-on-write 共用
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+if worker_class == "gevent":
+    # preload 時 app 在 master 裡 import，要在那之前 patch，鎖與 socket 才會是 gevent 的版本
+    from gevent import monkey
+
+    monkey.patch_all()
+
+if preload_app and hasattr(gc, "freeze"):
+    # import 期間不做 GC，避免在共用的記憶體頁上留下空洞
+    gc.disable()
+
+    def pre_fork(server, worker):
+        # 把目前所有物件移出 GC 的追蹤，worker 做 GC 時不會改寫 (複製) 這些頁；
+        # 每次 fork 前都做一次，master 之後建立的物件 (例如重開 worker 時) 也一起移出
+        gc.freeze()
+        # import 已經結束，master 與 fork 出的 worker 都恢復 GC
+        gc.enable()
+
+
+# =========== 統計 ===========
+def on_starting(server):
+    import metrics
+
+    # 上一次執行留下的統計檔不算
+    metrics.registry.clear()
+
+
+def child_exit(server, worker):
+    import metrics
+
+    # 結束的 worker 只留下 counter 與 histogram，pid 之後被別的 process 用到也不會算錯
+    metrics.registry.mark_dead(worker.pid)
+
+
+# =========== 逾時 ===========
+# 一次呼叫 LINE API 最多花的時間，與 app.py 的 LINE_CONNECT_TIMEOUT / LINE_READ_TIMEOUT 相同
+line_budget = float(os.environ.get("LINE_CONNECT_TIMEOUT", 3.05)) + float(
+    os.environ.get("LINE_READ_TIMEOUT", 10)
+)
+# 一個請求最多呼叫兩次 (reply 失敗後改用 push)，超過就是卡住了
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", math.ceil(2 * line_budget) + 5))
+# 收到 SIGTERM 後讓進行中的回覆與背景佇列 (最多 10 秒) 送完，Heroku 30 秒後會強制結束
+graceful_timeout = int(
+    os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", min(math.ceil(line_budget) + 10, 28))
+)
+# 兩次 webhook 之間保留連線的秒數 (sync worker 不支援)
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+bind = f"{os.environ.get('IP', '0.0.0.0')}:{os.environ.get('PORT', '8000')}"
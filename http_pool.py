@@ -0,0 +1,84 @@
+import logging
+import socket
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from linebot.http_client import HttpClient, RequestsHttpResponse
+
+logger = logging.getLogger(__name__)
+
+# 閒置 60 秒後開始送 TCP keep-alive，避免 NAT / LB 把閒置的連線切掉
+KEEPALIVE_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for _name, _value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15), ("TCP_KEEPCNT", 4)):
+    if hasattr(socket, _name):
+        KEEPALIVE_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, _name), _value))
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + (
+            KEEPALIVE_OPTIONS
+        )
+        super().init_poolmanager(*args, **kwargs)
+
+
+class PooledHttpClient(HttpClient):
+    """
+    共用同一個 requests.Session 的 HttpClient
+
+    連線保留在 pool 裡重複使用，不用每次回覆都重新做 TCP/TLS 握手。
+
+    :params timeout: (connect, read) 秒數，或單一數字
+    :params pool_size: 每個 host 最多保留的連線數，建議設成同時送出回覆的 thread 數
+    :params on_response: 每次呼叫結束後執行 on_response(method, url, status_code, seconds)，
+        連線失敗時 status_code 為 None
+    """
+
+    def __init__(
+        self, timeout=HttpClient.DEFAULT_TIMEOUT, pool_size=10, on_response=None
+    ):
+        super().__init__(timeout)
+        self.on_response = on_response
+        self.session = requests.Session()
+        adapter = KeepAliveAdapter(
+            pool_connections=2, pool_maxsize=pool_size, max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        status_code = None
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+            status_code = response.status_code
+        finally:
+            seconds = time.perf_counter() - start
+            if self.on_response is not None:
+                try:
+                    self.on_response(method, url, status_code, seconds)
+                except Exception:
+                    logger.exception("on_response 執行失敗")
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request(
+            "GET", url, headers=headers, params=params, stream=stream, timeout=timeout
+        )
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, headers=headers, data=data, timeout=timeout)
+
+    def close(self):
+        self.session.close()
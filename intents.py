@@ -0,0 +1,34 @@
+"""
+機器人的所有選項，內容寫在 content/flows.json，啟動時編譯成 flows.FlowGraph
+
+檔案修改後會在背景重新編譯並換上 (見 content.ContentStore)，
+同一個請求請只呼叫一次 current()，之後都用拿到的那一份 graph。
+"""
+import os
+
+import content
+import flows
+
+FLOWS_PATH = os.environ.get(
+    "FLOWS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "content", "flows.json"),
+)
+
+# CONTENT_RELOAD_INTERVAL=0 時不檢查檔案變動
+store = content.ContentStore(
+    FLOWS_PATH,
+    flows.load,
+    interval=float(os.environ.get("CONTENT_RELOAD_INTERVAL", 5)),
+)
+
+
+def current():
+    return store.current
+
+
+def dispatch(text, host=""):
+    return store.current.dispatch(text, host)
+
+
+def reply_for(text, host=""):
+    return store.current.reply_for(text, host)
@@ -0,0 +1,484 @@
+"""
+Prometheus 文字格式的統計
+
+記錄時不加鎖：每個 thread 寫自己的一份數字 (threading.local)，輸出時才把所有 thread 的加總，
+鎖只在 thread 第一次寫入某個統計時用到一次。
+
+gunicorn 的每個 worker 各自記錄，背景 thread 每隔幾秒把自己的數字寫到 METRICS_DIR/<pid>.json，
+/metrics 讀取資料夾裡所有 worker 的檔案加總後輸出。已經結束的 worker 只保留 counter 與 histogram，
+gauge (例如佇列長度) 只算還活著的 worker。
+gunicorn.conf.py 在 master 啟動時清空資料夾 (clear)，worker 結束時把它的數字併入 dead.json (mark_dead)，
+資料夾裡只會有還活著的 worker 與一個 dead.json。
+"""
+import atexit
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# 秒
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# 已經結束的 worker 的檔案名稱開頭
+DEAD_PREFIX = "dead"
+
+
+class _Metric:
+    type = None
+    registry = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._local = threading.local()
+        # (thread, 該 thread 的數字)，thread 結束後併入 _retired
+        self._shards = []
+        self._retired = {}
+
+    def _values(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+            if self.registry is not None:
+                self.registry.ensure_started()
+            return values
+
+    def collect(self):
+        """回傳 {label 值的 tuple: 數字}"""
+        with self._lock:
+            alive = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    self._merge(self._retired, values)
+            self._shards = alive
+            total = {}
+            self._merge(total, self._retired)
+            for _, values in alive:
+                self._merge(total, values)
+        return total
+
+    @staticmethod
+    def _merge(into, values):
+        for key, value in list(values.items()):
+            into[key] = into.get(key, 0) + value
+
+
+class Counter(_Metric):
+    type = COUNTER
+
+    def inc(self, *labels, amount=1):
+        values = self._values()
+        values[labels] = values.get(labels, 0) + amount
+
+
+class Histogram(_Metric):
+    """
+    :params buckets: 各個 bucket 的上限，由小到大
+    """
+
+    type = HISTOGRAM
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def observe(self, value, *labels):
+        values = self._values()
+        counts = values.get(labels)
+        if counts is None:
+            # 各 bucket 的次數 (不累加)、超過最大 bucket 的次數、總和
+            counts = values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    @staticmethod
+    def _merge(into, values):
+        for key, counts in list(values.items()):
+            merged = into.get(key)
+            if merged is None:
+                into[key] = list(counts)
+            else:
+                for i, count in enumerate(counts):
+                    merged[i] += count
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class _Callback:
+    """輸出時才呼叫 func() 取得數字，func 回傳單一數字或 {label 值的 tuple: 數字}"""
+
+    def __init__(self, type, name, help, func, labels=()):
+        self.type = type
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labels = tuple(labels)
+        # fork 當下從 master 繼承的數字
+        self._offset = {}
+
+    def _read(self):
+        value = self.func()
+        if isinstance(value, dict):
+            return value
+        return {(): value}
+
+    def collect(self):
+        value = self._read()
+        if not self._offset:
+            return value
+        # 內容重新載入後物件換新、數字從 0 開始，不要減成負的
+        return {
+            key: max(count - self._offset.get(key, 0), 0)
+            for key, count in value.items()
+        }
+
+    def _after_fork(self):
+        """
+        counter 讀的是物件上的屬性，preload 時 worker 會繼承 master 的數字
+        (例如 BOT_HOST 預先建好回覆時的未命中次數)，記下 fork 當下的值，之後只輸出這個 worker 增加的部分
+        """
+        if self.type != COUNTER:
+            return
+        try:
+            self._offset = self._read()
+        except Exception:
+            logger.exception("讀取 %s 失敗", self.name)
+            self._offset = {}
+
+
+class Registry:
+    """
+    :params directory: 各 worker 寫入統計的資料夾，None 時只輸出目前的 process
+    :params interval: 每隔幾秒寫一次
+    """
+
+    def __init__(self, directory=None, interval=5.0):
+        self.directory = directory
+        self.interval = interval
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = threading.Event()
+        if hasattr(os, "register_at_fork"):
+            # fork 出來的 worker 不能帶著 master 的數字
+            ref = weakref.ref(self)
+            os.register_at_fork(
+                after_in_child=lambda: ref() is not None and ref()._after_fork()
+            )
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"重複的統計名稱：{metric.name!r}")
+        metric.registry = self
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def counter_func(self, name, help, func, labels=()):
+        """輸出時呼叫 func() 取得的累計數字，例如物件上的 hits 屬性"""
+        return self._register(_Callback(COUNTER, name, help, func, labels))
+
+    def gauge_func(self, name, help, func, labels=()):
+        """輸出時呼叫 func() 取得的目前數值，例如佇列長度"""
+        return self._register(_Callback(GAUGE, name, help, func, labels))
+
+    def _after_fork(self):
+        self._pid = None
+        self._stop = threading.Event()
+        for metric in self._metrics.values():
+            if isinstance(metric, _Metric):
+                metric._lock = threading.Lock()
+                metric._reset()
+            else:
+                metric._after_fork()
+
+    def ensure_started(self):
+        """第一次記錄時在背景啟動定期寫檔的 thread，fork 之後每個 worker 各自一個"""
+        if self.directory is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(self._pid)
+            if os.path.exists(path):
+                # 同一個 pid 之前的 process 已經結束，保留它的數字
+                os.replace(
+                    path,
+                    os.path.join(
+                        self.directory,
+                        f"{DEAD_PREFIX}-{self._pid}-{time.time_ns()}.json",
+                    ),
+                )
+            threading.Thread(target=self._run, name="metrics", daemon=True).start()
+            atexit.register(self.write)
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                logger.exception("寫入統計失敗")
+
+    def snapshot(self):
+        """目前 process 的統計，可以轉成 JSON"""
+        snapshot = {}
+        for name, metric in self._metrics.items():
+            try:
+                values = metric.collect()
+            except Exception:
+                logger.exception("取得統計 %s 失敗", name)
+                continue
+            snapshot[name] = {
+                "type": metric.type,
+                "help": metric.help,
+                "labels": list(metric.labels),
+                "buckets": list(getattr(metric, "buckets", ())),
+                "values": [[list(key), value] for key, value in values.items()],
+            }
+        return snapshot
+
+    def write(self):
+        """把目前 process 的統計寫到 directory/<pid>.json"""
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        """刪除 directory 裡所有的統計檔，給 gunicorn master 啟動時用"""
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith((".json", ".tmp")):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def mark_dead(self, pid):
+        """
+        把已經結束的 worker 的 counter 與 histogram 併入 dead.json 並刪掉它的檔案，
+        給 gunicorn master 的 child_exit 用 (只有 master 會寫 dead.json)
+        """
+        if self.directory is None:
+            return
+        path = self._path(pid)
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return
+        dead_path = os.path.join(self.directory, f"{DEAD_PREFIX}.json")
+        merged = {}
+        try:
+            with open(dead_path, encoding="utf-8") as f:
+                merged = json.load(f)
+        except (OSError, ValueError):
+            pass
+        for name, metric in snapshot.items():
+            if metric["type"] != GAUGE:
+                _merge_snapshot(merged, name, metric)
+        tmp_path = f"{dead_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(merged, f)
+        os.replace(tmp_path, dead_path)
+        os.remove(path)
+
+    def collect(self):
+        """所有 worker 加總後的統計"""
+        if self.directory is None:
+            return self.snapshot()
+        self.ensure_started()
+        self.write()
+        merged = {}
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            alive = not name.startswith(DEAD_PREFIX) and _alive(name[: -len(".json")])
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric_name, metric in snapshot.items():
+                if metric["type"] == GAUGE and not alive:
+                    continue
+                _merge_snapshot(merged, metric_name, metric)
+        return merged
+
+    def render(self):
+        """Prometheus 文字格式"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {_escape_help(metric['help'])}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            labels = metric["labels"]
+            for key, value in sorted(metric["values"], key=lambda item: item[0]):
+                if metric["type"] != HISTOGRAM:
+                    lines.append(f"{name}{_labels(labels, key)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric["buckets"] + ["+Inf"], value[:-1]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _number(bound)
+                    lines.append(
+                        f"{name}_bucket{_labels(labels + ['le'], key + [le])} "
+                        f"{_number(cumulative)}"
+                    )
+                lines.append(f"{name}_sum{_labels(labels, key)} {_number(value[-1])}")
+                lines.append(
+                    f"{name}_count{_labels(labels, key)} {_number(cumulative)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ValueError:
+        return False
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge_snapshot(merged, name, metric):
+    target = merged.get(name)
+    if target is None:
+        merged[name] = dict(metric, values=[[k, v] for k, v in metric["values"]])
+        return
+    index = {tuple(key): i for i, (key, _) in enumerate(target["values"])}
+    for key, value in metric["values"]:
+        i = index.get(tuple(key))
+        if i is None:
+            target["values"].append([key, value])
+        elif metric["type"] == HISTOGRAM:
+            target["values"][i][1] = [
+                a + b for a, b in zip(target["values"][i][1], value)
+            ]
+        else:
+            target["values"][i][1] += value
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _escape_help(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# METRICS_DIR 預設為系統暫存資料夾，設成 off 時只輸出處理 /metrics 的那個 worker
+METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(
+    tempfile.gettempdir(), "dromnet-metrics"
+)
+registry = Registry(
+    None if METRICS_DIR == "off" else METRICS_DIR,
+    interval=float(os.environ.get("METRICS_FLUSH_INTERVAL", 5)),
+)
+
+# =========== 機器人的統計 ===========
+intent_seconds = registry.histogram(
+    "dromnet_intent_seconds", "處理一則文字訊息的時間 (含送出回覆)", ["intent"]
+)
+signature_seconds = registry.histogram(
+    "dromnet_signature_seconds",
+    "驗證 webhook 簽章的時間",
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005),
+)
+signature_failures = registry.counter(
+    "dromnet_signature_failures_total", "簽章不符的 webhook 數"
+)
+line_api_seconds = registry.histogram(
+    "dromnet_line_api_seconds", "呼叫 LINE API 的時間", ["path"]
+)
+line_api_responses = registry.counter(
+    "dromnet_line_api_responses_total",
+    "LINE API 的回應，連線失敗時 status 為 error",
+    ["path", "status"],
+)
+
+
+def record_line_api(method, url, status_code, seconds):
+    """給 http_pool.PooledHttpClient 的 on_response"""
+    path = urlsplit(url).path
+    line_api_seconds.observe(seconds, path)
+    line_api_responses.inc(path, "error" if status_code is None else str(status_code))
@@ -0,0 +1,55 @@
+"""
+使用者輸入文字的正規化
+
+比對選項前先把輸入轉成統一的形式，讓「2宿3樓」、「二宿 三樓」、「Windows10」
+這類打法也能對到「二宿三樓」、「Windows 10」：
+    全形轉半形 (NFKC)、大小寫、去掉空白與結尾的標點、國字數字轉成阿拉伯數字
+只掃過輸入一次，之後用 dict 查詢，成本與輸入長度成正比。
+"""
+import re
+import unicodedata
+
+CHINESE_DIGITS = {
+    "零": 0,
+    "〇": 0,
+    "一": 1,
+    "二": 2,
+    "兩": 2,
+    "三": 3,
+    "四": 4,
+    "五": 5,
+    "六": 6,
+    "七": 7,
+    "八": 8,
+    "九": 9,
+}
+CHINESE_UNITS = {"十": 10, "百": 100}
+
+_NUMERAL_RUN = re.compile("[%s]+" % "".join(list(CHINESE_DIGITS) + list(CHINESE_UNITS)))
+_SPACES = re.compile(r"\s+")
+TRAILING_PUNCTUATION = "!?.,~。，、？！～…"
+
+
+def chinese_to_arabic(run):
+    """
+    「三」-> 「3」、「十二」-> 「12」、「一四零一」-> 「1401」
+
+    沒有十、百時逐字轉換 (房號常這樣念)，有的話照數值計算
+    """
+    if not any(ch in CHINESE_UNITS for ch in run):
+        return "".join(str(CHINESE_DIGITS[ch]) for ch in run)
+    total = 0
+    current = 0
+    for ch in run:
+        if ch in CHINESE_DIGITS:
+            current = CHINESE_DIGITS[ch]
+        else:
+            total += (current or 1) * CHINESE_UNITS[ch]
+            current = 0
+    return str(total + current)
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = _SPACES.sub("", text).rstrip(TRAILING_PUNCTUATION)
+    return _NUMERAL_RUN.sub(lambda m: chinese_to_arabic(m.group()), text)
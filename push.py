@@ -0,0 +1,132 @@
+"""
+reply token 過期時改用 push 送出
+
+處理太慢 (worker 忙、佇列塞住) 時 reply token 會過期，reply_message 失敗使用者就什麼都收不到。
+事件太舊或 LINE 回覆 "Invalid reply token" 時，把準備好的回覆交給 PushQueue：
+同一個使用者累積的多則回覆只送最新的一則，內容相同的使用者合併成 multicast，
+經過 token bucket 限流後在背景送出。
+"""
+import atexit
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+
+from announce import batches, send_with_retries
+from replies import multicast_raw, push_raw
+
+logger = logging.getLogger(__name__)
+
+
+def event_age(event, now=None):
+    """事件從 LINE 送出到現在經過的秒數"""
+    now = time.time() if now is None else now
+    return now - event.timestamp / 1000
+
+
+def reply_expired(event, ttl):
+    """事件是否已經舊到 reply token 很可能過期"""
+    return event_age(event) > ttl
+
+
+def is_invalid_reply_token(error):
+    """LineBotApiError 是否表示 reply token 已經失效"""
+    message = getattr(error.error, "message", "") or ""
+    return error.status_code == 400 and "reply token" in message.lower()
+
+
+class PushQueue:
+    """
+    :params line_bot_api
+    :params bucket: TokenBucket，每次 push / multicast 取一個 token
+    :params interval: 每隔幾秒把累積的回覆送出
+    :params maxsize: 最多同時等待的使用者數，超過時丟掉新的
+    :params retries: 每次送出最多重試幾次
+    """
+
+    def __init__(
+        self, line_bot_api, bucket, interval=0.5, maxsize=10000, retries=2, backoff=0.5
+    ):
+        self.line_bot_api = line_bot_api
+        self.bucket = bucket
+        self.interval = interval
+        self.maxsize = maxsize
+        self.retries = retries
+        self.backoff = backoff
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def submit(self, user_id, reply):
+        """排入 user_id 的回覆 (dispatch.Reply)，同一個使用者只保留最新的一則。"""
+        self._ensure_started()
+        with self._lock:
+            self.submitted += 1
+            if user_id in self._pending:
+                self.coalesced += 1
+            elif len(self._pending) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self._pending[user_id] = reply
+        return True
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="push", daemon=True).start()
+            self._pid = os.getpid()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while not self._wake.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("push 失敗")
+
+    def flush(self):
+        """送出目前累積的所有回覆，回傳送達的使用者數。"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        # 內容相同的使用者合併成一次 multicast
+        groups = {}
+        for user_id, reply in pending.items():
+            groups.setdefault(reply.payload, []).append(user_id)
+
+        delivered = 0
+        for payload, user_ids in groups.items():
+            for group in batches(user_ids):
+                if len(group) == 1:
+                    send = functools.partial(push_raw, self.line_bot_api, group[0])
+                else:
+                    send = functools.partial(multicast_raw, self.line_bot_api, group)
+                ok = send_with_retries(
+                    functools.partial(send, payload, retry_key=str(uuid.uuid4())),
+                    self.bucket,
+                    self.retries,
+                    self.backoff,
+                )
+                if ok:
+                    delivered += len(group)
+                else:
+                    self.failed += len(group)
+        self.sent += delivered
+        return delivered
@@ -0,0 +1,209 @@
+"""
+Token bucket 限流
+
+每秒補充 rate 個 token，最多存 capacity 個；每次動作消耗 token，不夠時等待或拒絕。
+MemoryLimiter / SQLiteLimiter 依 key (例如 user_id) 各自一個 bucket，
+InboundLimiter 用它們擋下短時間內太多的 webhook 事件。
+"""
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    :params rate: 每秒補充的 token 數
+    :params capacity: 最多能存的 token 數，也就是瞬間最多能做幾次
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def try_acquire(self, n=1):
+        """有 n 個 token 時取走並回傳 True，否則回傳 False。"""
+        with self._lock:
+            self._refill(self._clock())
+            if self._tokens >= n:
+                self._tokens -= n
+                return True
+            return False
+
+    def wait_time(self, n=1):
+        """還要等幾秒才有 n 個 token"""
+        with self._lock:
+            self._refill(self._clock())
+            return max(0.0, (n - self._tokens) / self.rate)
+
+    def acquire(self, n=1, timeout=None):
+        """等到有 n 個 token 為止，超過 timeout 秒時回傳 False。"""
+        deadline = None if timeout is None else self._clock() + timeout
+        while not self.try_acquire(n):
+            wait = self.wait_time(n)
+            if deadline is not None and self._clock() + wait > deadline:
+                return False
+            time.sleep(wait)
+        return True
+
+
+class MemoryLimiter:
+    """
+    以 key 區分的 TokenBucket，只在同一個 process 內有效
+
+    :params rate: 每個 key 每秒補充的 token 數
+    :params capacity: 每個 key 最多能存的 token 數
+    :params maxsize: 最多記住幾個 key，超過時淘汰最久沒用到的 (token 一定是滿的)
+    """
+
+    def __init__(self, rate, capacity=None, maxsize=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        return bucket.try_acquire()
+
+
+class SQLiteLimiter:
+    """
+    存在 SQLite 檔案裡的 TokenBucket，同一台機器上的所有 gunicorn worker 共用
+
+    資料庫出問題時一律放行，不因為限流擋掉正常的使用者。
+
+    :params path: 資料庫檔案
+    :params rate: 每個 key 每秒補充的 token 數
+    :params capacity: 每個 key 最多能存的 token 數
+    :params prefix: 加在 key 前面，讓多個 limiter 共用同一個檔案
+    :params purge_every: 每幾次清一次已經補滿的 key
+    """
+
+    def __init__(self, path, rate, capacity=None, prefix="", purge_every=1000):
+        self.prefix = prefix
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.purge_every = purge_every
+        self._calls = 0
+        self._connect = storage.LocalConnection(path).get
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS buckets "
+            "(key TEXT PRIMARY KEY, tokens REAL, updated REAL) WITHOUT ROWID"
+        )
+
+    def allow(self, key):
+        key = f"{self.prefix}:{key}"
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens = self.capacity
+                if row is not None:
+                    tokens = min(self.capacity, row[0] + (now - row[1]) * self.rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+                self._calls += 1
+                if self._calls % self.purge_every == 0:
+                    # 已經補滿的 bucket 跟不存在一樣
+                    conn.execute(
+                        "DELETE FROM buckets WHERE key LIKE ? AND updated < ?",
+                        (f"{self.prefix}:%", now - self.capacity / self.rate),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            logger.exception("限流資料庫錯誤，放行")
+            return True
+        return allowed
+
+
+MEMORY = "memory"
+SQLITE = "sqlite"
+BACKENDS = (MEMORY, SQLITE)
+
+
+def create(backend, rate, capacity=None, path=None, prefix=""):
+    """
+    :params prefix: SQLite 版用來區分共用同一個檔案的 limiter
+    """
+    if backend == MEMORY:
+        return MemoryLimiter(rate, capacity)
+    if backend == SQLITE:
+        return SQLiteLimiter(path, rate, capacity, prefix)
+    raise ValueError(f"未知的 backend：{backend!r}，可用的有 {BACKENDS}")
+
+
+GLOBAL_KEY = "*"
+
+
+class InboundLimiter:
+    """
+    webhook 事件的限流：先看使用者自己的額度，再看全體的額度
+
+    超過時只回覆一次「請慢一點」，之後 warn 額度用完前的事件直接丟掉。
+
+    :params per_user: 以 user_id 為 key 的 limiter
+    :params overall: 全體共用的 limiter (key 為 GLOBAL_KEY)，None 表示不限制
+    :params warn: 控制多久回覆一次「請慢一點」的 limiter
+    """
+
+    def __init__(self, per_user, overall=None, warn=None):
+        self.per_user = per_user
+        self.overall = overall
+        self.warn = warn
+        self.allowed = 0
+        self.limited_user = 0
+        self.limited_global = 0
+        self.warned = 0
+
+    def check(self, user_id):
+        """可以處理時回傳 None，否則回傳 "user" 或 "global"。"""
+        if user_id is not None and not self.per_user.allow(user_id):
+            self.limited_user += 1
+            return "user"
+        if self.overall is not None and not self.overall.allow(GLOBAL_KEY):
+            self.limited_global += 1
+            return "global"
+        self.allowed += 1
+        return None
+
+    def should_warn(self, user_id):
+        if user_id is None or self.warn is None or not self.warn.allow(user_id):
+            return False
+        self.warned += 1
+        return True
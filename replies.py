@@ -0,0 +1,119 @@
+import json
+
+REPLY_PATH = "/v2/bot/message/reply"
+
+
+def reply_body(reply_token, payload, notification_disabled=False):
+    """
+    reply API 的 request body (bytes)
+
+    :params reply_token
+    :params payload: Reply.payload，messages 的 JSON array (bytes)
+    """
+    return b"".join(
+        (
+            b'{"replyToken":',
+            json.dumps(reply_token).encode("utf-8"),
+            b',"messages":',
+            payload,
+            b',"notificationDisabled":',
+            b"true" if notification_disabled else b"false",
+            b"}",
+        )
+    )
+
+
+def reply_raw(
+    line_bot_api, reply_token, payload, notification_disabled=False, timeout=None
+):
+    """
+    用已經序列化好的 messages 直接呼叫 reply API
+
+    跟 LineBotApi.reply_message 走同一個 _post，
+    失敗時一樣丟出 LineBotApiError。
+
+    :params reply_token
+    :params payload: Reply.payload，messages 的 JSON array (bytes)
+    """
+    return line_bot_api._post(
+        REPLY_PATH,
+        data=reply_body(reply_token, payload, notification_disabled),
+        headers={"Content-Type": "application/json; charset=UTF-8"},
+        timeout=timeout,
+    )
+
+
+PUSH_PATH = "/v2/bot/message/push"
+MULTICAST_PATH = "/v2/bot/message/multicast"
+
+
+def _send_raw(
+    line_bot_api, path, head, payload, notification_disabled, retry_key, timeout
+):
+    body = b"".join(
+        (
+            head,
+            b',"messages":',
+            payload,
+            b',"notificationDisabled":',
+            b"true" if notification_disabled else b"false",
+            b"}",
+        )
+    )
+    headers = {"Content-Type": "application/json; charset=UTF-8"}
+    if retry_key is not None:
+        # 不用 SDK 的 retry_key 參數，它會把 header 留在 line_bot_api 上影響之後的呼叫
+        headers["X-Line-Retry-Key"] = retry_key
+    return line_bot_api._post(path, data=body, headers=headers, timeout=timeout)
+
+
+def push_raw(
+    line_bot_api,
+    to,
+    payload,
+    notification_disabled=False,
+    retry_key=None,
+    timeout=None,
+):
+    """
+    用已經序列化好的 messages 呼叫 push API
+
+    :params to: user_id
+    :params retry_key: 重試時帶同一個 UUID，LINE 不會重複送出
+    """
+    head = b'{"to":' + json.dumps(to).encode("utf-8")
+    return _send_raw(
+        line_bot_api,
+        PUSH_PATH,
+        head,
+        payload,
+        notification_disabled,
+        retry_key,
+        timeout,
+    )
+
+
+def multicast_raw(
+    line_bot_api,
+    to,
+    payload,
+    notification_disabled=False,
+    retry_key=None,
+    timeout=None,
+):
+    """
+    用已經序列化好的 messages 呼叫 multicast API
+
+    :params to: user_id 的 list，一次最多 500 個
+    :params retry_key: 重試時帶同一個 UUID，LINE 不會重複送出
+    """
+    head = b'{"to":' + json.dumps(list(to)).encode("utf-8")
+    return _send_raw(
+        line_bot_api,
+        MULTICAST_PATH,
+        head,
+        payload,
+        notification_disabled,
+        retry_key,
+        timeout,
+    )
@@ -0,0 +1,186 @@
+"""
+即時縮圖：/img/<width>/<path> 把 static/img 底下的圖片縮成指定寬度
+
+結果存在磁碟上，總大小超過上限時淘汰最久沒用到的檔案。
+同一張圖同一個寬度第一次被同時請求時只會縮一次：
+同一個 process 內用 threading.Lock，不同 gunicorn worker 之間用 flock。
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import assets
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只做 process 內的 single-flight
+    fcntl = None
+
+ALLOWED_WIDTHS = (240, 480, 640, 800, 1024)
+QUALITY = 80
+
+
+class ResizeCache:
+    """
+    :params cache_dir: 縮圖存放的資料夾
+    :params max_bytes: 縮圖總大小上限
+    :params widths: 允許的寬度
+    """
+
+    def __init__(self, cache_dir, max_bytes=100 * 1024 * 1024, widths=ALLOWED_WIDTHS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.widths = frozenset(widths)
+        self._entries = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        # 依修改時間排序，最舊的先淘汰；命中時會更新檔案的修改時間
+        found = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".jpg"):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            found.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total += size
+
+    def _key(self, path, width):
+        digest = hashlib.sha1(
+            f"{path}:{assets.content_hash(path)}:{width}".encode("utf-8")
+        ).hexdigest()
+        return f"{width}-{digest[:24]}.jpg"
+
+    def get(self, path, width):
+        """
+        回傳縮好的檔案路徑，path 不存在、不是 assets.SOURCE_EXTENSIONS 的圖片或 width 不允許時回傳 None
+
+        :params path: 相對於 static/img 的路徑
+        """
+        if width not in self.widths:
+            return None
+        if not path.lower().endswith(assets.SOURCE_EXTENSIONS):
+            # manifest.json 之類不是圖片的檔案不要交給 PIL
+            return None
+        src = os.path.normpath(os.path.join(assets.IMG_DIR, path))
+        if not src.startswith(assets.IMG_DIR + os.sep) or not os.path.isfile(src):
+            return None
+
+        name = self._key(path, width)
+        out = os.path.join(self.cache_dir, name)
+        if self._touch(name, out):
+            self.hits += 1
+            return out
+
+        with self._flight(name):
+            # 等鎖的期間別人可能已經縮好了
+            if self._touch(name, out):
+                self.hits += 1
+                return out
+            self.misses += 1
+            size = self._resize(src, out, width)
+            self._add(name, size)
+        return out
+
+    def _touch(self, name, out):
+        try:
+            os.utime(out)
+        except FileNotFoundError:
+            with self._lock:
+                self._total -= self._entries.pop(name, 0)
+            return False
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+            else:
+                # 其他 worker 縮好的
+                size = os.path.getsize(out)
+                self._entries[name] = size
+                self._total += size
+        return True
+
+    def _flight(self, name):
+        with self._lock:
+            flight = self._inflight.get(name)
+            if flight is None:
+                flight = self._inflight[name] = _Flight(self, name)
+            flight.waiters += 1
+        return flight
+
+    def _resize(self, src, out, width):
+        from PIL import Image
+
+        with Image.open(src) as opened:
+            image = assets.flatten(opened)
+        if image.width > width:
+            height = round(image.height * width / image.width)
+            image = image.resize((width, height), Image.LANCZOS)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, "JPEG", quality=QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, out)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return os.path.getsize(out)
+
+    def _add(self, name, size):
+        evicted = []
+        with self._lock:
+            self._entries[name] = size
+            self._total += size
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                evicted.append(old)
+        for old in evicted:
+            for leftover in (old, old + ".lock"):
+                try:
+                    os.unlink(os.path.join(self.cache_dir, leftover))
+                except FileNotFoundError:
+                    pass
+
+    @property
+    def total_bytes(self):
+        return self._total
+
+
+class _Flight:
+    """同一個縮圖的 single-flight 鎖，最後一個使用者離開時移除。"""
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self.waiters = 0
+        self.lock = threading.Lock()
+        self._lock_file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if fcntl is not None:
+            self._lock_file = open(
+                os.path.join(self.cache.cache_dir, self.name + ".lock"), "w"
+            )
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+        self.lock.release()
+        with self.cache._lock:
+            self.waiters -= 1
+            if self.waiters == 0:
+                del self.cache._inflight[self.name]
@@ -0,0 +1,31 @@
+"""
+房號索引
+
+房號的第一位是宿舍、第二位是樓層、後兩碼是房間，例如 2301 是二宿三樓。
+使用者直接打房號時一次就回覆該樓層的帳號說明，不用再一層一層點選。
+"""
+import re
+
+# 比對的是 normalize 過的文字，「一四零一」、「1401房」都會變成這個形式
+ROOM_PATTERN = re.compile(r"(\d)(\d)\d\d(?:號房|房)?", re.ASCII)
+
+
+class RoomIndex:
+    """
+    :params floors: 「宿舍+樓層」(例如 "23") 對應到的值
+    :params error: 格式是房號但沒有這個宿舍或樓層時回傳的值
+    """
+
+    def __init__(self, floors, error):
+        self.floors = dict(floors)
+        self.error = error
+
+    def lookup(self, key):
+        """key 不是房號時回傳 None"""
+        match = ROOM_PATTERN.fullmatch(key)
+        if match is None:
+            return None
+        return self.floors.get(match.group(1) + match.group(2), self.error)
+
+    def values(self):
+        return list(self.floors.values()) + [self.error]
@@ -0,0 +1,127 @@
+"""
+使用者目前在對話流程中的位置
+
+以 user_id 記錄最後到達的節點，讓同一句話 (例如「已完成」) 可以依前一步回覆不同內容。
+記憶體版有筆數上限，超過時淘汰最久沒說話的使用者，逾時的紀錄也會丟掉；
+SQLite 版存在檔案裡，同一台機器上的所有 gunicorn worker 共用。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import storage
+
+MEMORY = "memory"
+SQLITE = "sqlite"
+BACKENDS = (MEMORY, SQLITE)
+
+
+class Session:
+    """
+    :params node: 最後到達的節點名稱，fallback 時為 None
+    :params updated: 最後更新的時間 (time.time())
+    """
+
+    __slots__ = ("node", "updated")
+
+    def __init__(self, node, updated=None):
+        self.node = node
+        self.updated = time.time() if updated is None else updated
+
+    def __repr__(self):
+        return f"Session(node={self.node!r})"
+
+
+class MemorySessions:
+    """
+    :params ttl: 多久沒說話就忘記位置 (秒)
+    :params maxsize: 最多記住幾個使用者
+    """
+
+    def __init__(self, ttl=1800, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """回傳 user_id 的 Session，沒有或已逾時時回傳 None。"""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                return None
+            if session.updated + self.ttl <= time.time():
+                del self._sessions[user_id]
+                return None
+            return session
+
+    def put(self, user_id, node):
+        """記錄 user_id 到達 node"""
+        now = time.time()
+        with self._lock:
+            self._sessions.pop(user_id, None)
+            self._sessions[user_id] = Session(node, now)
+            # 依更新時間排列，最前面的最久沒說話
+            while self._sessions and (
+                len(self._sessions) > self.maxsize
+                or next(iter(self._sessions.values())).updated + self.ttl <= now
+            ):
+                self._sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLiteSessions:
+    """
+    :params path: 資料庫檔案
+    :params ttl: 多久沒說話就忘記位置 (秒)
+    :params purge_every: 每寫入幾次清一次逾時的紀錄
+    """
+
+    def __init__(self, path, ttl=1800, purge_every=500):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._connect = storage.LocalConnection(path).get
+        self._writes = 0
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(user_id TEXT PRIMARY KEY, node TEXT, updated REAL)"
+        )
+
+    def get(self, user_id):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT node, updated FROM sessions "
+                "WHERE user_id = ? AND updated > ?",
+                (user_id, time.time() - self.ttl),
+            )
+            .fetchone()
+        )
+        return Session(*row) if row is not None else None
+
+    def put(self, user_id, node):
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT INTO sessions (user_id, node, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET "
+            "node = excluded.node, updated = excluded.updated",
+            (user_id, node, now),
+        )
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            conn.execute("DELETE FROM sessions WHERE updated <= ?", (now - self.ttl,))
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def create(backend=MEMORY, path=None, ttl=1800, maxsize=10000):
+    if backend == MEMORY:
+        return MemorySessions(ttl, maxsize)
+    if backend == SQLITE:
+        return SQLiteSessions(path, ttl)
+    raise ValueError(f"未知的 backend：{backend!r}，可用的有 {BACKENDS}")
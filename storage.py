@@ -0,0 +1,31 @@
+import os
+import sqlite3
+import threading
+
+
+class LocalConnection:
+    """
+    每個 thread 各自一條 SQLite 連線
+
+    sqlite 連線不能跨 thread 或 fork 使用，fork 之後 (gunicorn worker) 也會重新連線。
+    使用 WAL，讀寫可以同時進行，多個 worker 共用同一個檔案。
+
+    :params path: 資料庫檔案
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
@@ -7,6 +7,8 @@ from linebot.models.template import (
     TemplateSendMessage,
 )
 
+import assets
+
 
 def Separate(n):
     return "=" * n
@@ -50,13 +52,19 @@ def ButtonWindow(title, context, number, label_list):
         )
         return buttons_template_message
     else:
-        # FIXME 這邊到時候再寫判斷，基本上我自己寫不會去故意設不一樣的值 ...
-        pass
+        raise ValueError(f"number ({number}) 與 label_list 的數量 ({len(label_list)}) 不同")
 
 
 def ImageWindow(origin_path, preview_path=None):
+    """
+    圖片訊息，static/img 底下的圖片會自動換成建置好的完整圖與預覽圖
+
+    :params origin_path
+    :params preview_path: 沒有給的話用 origin_path 的預覽版本
+    """
     if preview_path == None:
-        preview_path = origin_path
+        preview_path = assets.variant_url(origin_path, "preview")
+    origin_path = assets.variant_url(origin_path, "full")
 
     image_message = ImageSendMessage(
         original_content_url=f"{origin_path}",